@@ -0,0 +1,102 @@
+"""
+Benchmark of the analysis result cache (views.ResultCache) under concurrent
+request load.
+
+threads clients request /output for hashtags drawn from a Zipf-like
+distribution (popular queries repeat), through Flask's test client, and
+fetch the plots of finished analyses. run_analysis is replaced by a stub that
+sleeps analysis_seconds and returns plots of plot_bytes, so only the web app
+and the cache are measured. Reports requests/sec, latency percentiles, how
+often each analysis ran (it should be once, unless evicted), and the cache
+metrics. Run from this directory:
+
+    python cache_bench.py [threads] [requests_per_thread]
+"""
+from __future__ import division, print_function
+import bisect
+import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flaskexample import app, views
+
+def benchmark(threads=16, requests_per_thread=400, n_queries=60, analysis_seconds=0.2,
+              plot_bytes=100000, cached_results=40, executor_threads=8, seed=0):
+    """
+    Returns a dict with the number of requests, wall-clock seconds, requests/sec,
+    p50 and p99 latency in seconds, plots not found, analyses run, distinct
+    analyses run, and the cache metrics. The cache holds about cached_results results by bytes.
+    """
+    runs = []
+    runs_lock = threading.Lock()
+
+    def stub_analysis(hashtag, start_time, duration, params=views.analysis_params):
+        with runs_lock:
+            runs.append((hashtag, start_time, float(duration)))
+        time.sleep(analysis_seconds)
+        return {'hashtag': hashtag, 'start_time': start_time, 'duration': duration,
+                'params': params, 'warning': hashtag.endswith('w'), 'complete': True,
+                'plots': {'Ntweets': os.urandom(plot_bytes), 'timeline': os.urandom(plot_bytes)}}
+
+    views.run_analysis = stub_analysis
+    views.executor = ThreadPoolExecutor(executor_threads)
+    views.results = views.ResultCache(max_bytes=cached_results * (2 * plot_bytes + 1000))
+
+    # Every tenth query has too few tweets; durations are given as '60' or '60.0'
+    queries = [('#tag%d' % i + ('w' if i % 10 == 0 else ''), '2017-06-08-14-00', '60')
+               for i in range(n_queries)]
+    cumulative = []
+    total = 0
+    for i in range(n_queries):
+        total += 1 / (i + 1)
+        cumulative.append(total)
+
+    latencies = []
+    missing_plots = [0]
+    latencies_lock = threading.Lock()
+
+    def client(n):
+        rng = random.Random(seed + n)
+        test_client = app.test_client()
+        for _ in range(requests_per_thread):
+            hashtag, start_time, duration = queries[bisect.bisect(cumulative, rng.uniform(0, total))]
+            if rng.random() < 0.5:
+                duration += '.0'
+            t0 = time.time()
+            body = test_client.get('/output', query_string={'hashtag': hashtag, 'start_time': start_time,
+                                                             'duration': duration}).data
+            # A plot is missing only if its result was evicted since the page was served
+            missing = sum(test_client.get(url.decode('ascii')).status_code == 404
+                          for url in re.findall(br'/plots/[^\s"\'>]+', body))
+            with latencies_lock:
+                latencies.append(time.time() - t0)
+                missing_plots[0] += missing
+
+    start = time.time()
+    workers = [threading.Thread(target=client, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.time() - start
+    views.executor.shutdown()
+
+    latencies.sort()
+    return {'requests': len(latencies), 'seconds': wall, 'requests_per_sec': len(latencies) / wall,
+            'p50': latencies[len(latencies) // 2], 'p99': latencies[int(len(latencies) * 0.99)],
+            'missing_plots': missing_plots[0], 'analyses': len(runs), 'distinct_analyses': len(set(runs)),
+            'cache': views.results.metrics()}
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    requests_per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    stats = benchmark(threads, requests_per_thread)
+    print('%d requests in %.2f s: %.0f req/s, p50 %.2f ms, p99 %.2f ms'
+          % (stats['requests'], stats['seconds'], stats['requests_per_sec'],
+             1000 * stats['p50'], 1000 * stats['p99']))
+    print('%d analyses run, %d distinct, %d plots evicted before they were fetched'
+          % (stats['analyses'], stats['distinct_analyses'], stats['missing_plots']))
+    print('cache: %s' % stats['cache'])
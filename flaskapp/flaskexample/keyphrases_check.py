@@ -0,0 +1,100 @@
+"""
+Regression check and microbenchmark for textrank.mergeKeyphrases.
+
+Compares mergeKeyphrases against a copy of the original merge loop of
+extractKeyphrases on random token lists, then times both on concatenated
+peak texts of 1e4 to 1e6 tokens. Run from this directory:
+
+    python keyphrases_check.py [n_texts]
+"""
+from __future__ import division, print_function
+import sys
+import time
+import numpy as np
+from textrank import mergeKeyphrases
+
+def merge_loop(textlist, keyphrases, scores):
+    """
+    The original merge loop of extractKeyphrases, kept as the reference
+    implementation; keyphrases is a list, as it was there.
+    """
+    modifiedKeyphrases = {}
+    dealtWith = set([])
+    i = 0
+    j = 1
+    while j < len(textlist):
+        firstWord = textlist[i]
+        secondWord = textlist[j]
+        if firstWord in keyphrases and secondWord in keyphrases:
+            keyphrase = firstWord + ' ' + secondWord
+            modifiedKeyphrases[keyphrase] = scores[firstWord] + scores[secondWord]
+            dealtWith.add(firstWord)
+            dealtWith.add(secondWord)
+        else:
+            if firstWord in keyphrases and firstWord not in dealtWith:
+                modifiedKeyphrases[firstWord] = scores[firstWord]
+
+            # if this is the last word in the text, and it is a keyword, it
+            # definitely has no chance of being a keyphrase at this point
+            if j == len(textlist) - 1 and secondWord in keyphrases and \
+                    secondWord not in dealtWith:
+                modifiedKeyphrases[secondWord] = scores[secondWord]
+
+        i = i + 1
+        j = j + 1
+
+    return modifiedKeyphrases
+
+def peak_text(rng, n_tokens, vocabulary):
+    """
+    Tokens of concatenated peak tweets: Zipf-distributed words of a vocabulary,
+    the top third of the words seen (by random score) being the keyphrases,
+    as extractKeyphrases keeps them. Returns (textlist, keyphrases, scores).
+    """
+    words = ['w%d' % i for i in range(vocabulary)]
+    ranks = np.minimum(rng.zipf(1.3, n_tokens), vocabulary) - 1
+    textlist = [words[k] for k in ranks]
+    seen = sorted(set(textlist))
+    scores = dict(zip(seen, rng.uniform(size = len(seen)).tolist()))
+    keyphrases = sorted(scores, key=scores.get, reverse=True)[:len(seen) // 3 + 1]
+    return textlist, keyphrases, scores
+
+def check(n_texts=2000, seed=0):
+    """
+    Returns the number of random texts on which mergeKeyphrases and
+    merge_loop disagree.
+    """
+    rng = np.random.RandomState(seed)
+    mismatches = 0
+    for k in range(n_texts):
+        textlist, keyphrases, scores = peak_text(rng, rng.randint(0, 60), rng.randint(1, 30))
+        if mergeKeyphrases(textlist, keyphrases, scores) != merge_loop(textlist, keyphrases, scores):
+            mismatches += 1
+            print('mismatch: text %d, %d tokens' % (k, len(textlist)))
+    return mismatches
+
+def benchmark(lengths=(10 ** 4, 10 ** 5, 10 ** 6), vocabulary=5000, loop_max=10 ** 5, seed=0):
+    """
+    Prints the seconds mergeKeyphrases and merge_loop take on peak texts of
+    each length in tokens; the loop is skipped above loop_max.
+    """
+    rng = np.random.RandomState(seed)
+    print('%10s %12s %12s %12s' % ('tokens', 'keyphrases', 'merge', 'loop'))
+    for n in lengths:
+        textlist, keyphrases, scores = peak_text(rng, n, vocabulary)
+        t0 = time.time()
+        mergeKeyphrases(textlist, keyphrases, scores)
+        merge = time.time() - t0
+        loop = float('nan')
+        if n <= loop_max:
+            t0 = time.time()
+            merge_loop(textlist, keyphrases, scores)
+            loop = time.time() - t0
+        print('%10d %12d %12.4f %12.4f' % (n, len(keyphrases), merge, loop))
+
+if __name__ == '__main__':
+    n_texts = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    mismatches = check(n_texts)
+    print('%d mismatches over %d texts' % (mismatches, n_texts))
+    benchmark()
+    sys.exit(1 if mismatches else 0)
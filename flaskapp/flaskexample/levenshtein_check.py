@@ -0,0 +1,97 @@
+"""
+Regression check and benchmark for textrank.levenshteinMatrix.
+
+Compares levenshteinMatrix against textrank.lDistance on every pair of random
+word sets (empty strings, non-ASCII characters, and shorter strings of up to
+and over 64 characters, which take the lDistance fallback), then times it on
+sets of distinct words of growing size. Run from this directory:
+
+    python levenshtein_check.py [n_sets]
+"""
+from __future__ import division, print_function
+import itertools
+import sys
+import time
+import numpy as np
+from textrank import lDistance, levenshteinMatrix
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# ASCII letters, accented Latin, Greek and CJK characters
+alphabets = [u'abcdefghijklmnopqrstuvwxyz',
+             u''.join(unichr(c) for c in range(0xe0, 0x100)),
+             u''.join(unichr(c) for c in range(0x3b1, 0x3ca)),
+             u''.join(unichr(c) for c in range(0x4e00, 0x4e20))]
+
+def random_word(rng, alphabet, max_length):
+    return u''.join(rng.choice(list(alphabet), rng.randint(0, max_length + 1)))
+
+def random_words(rng):
+    """
+    A random set of words: short ones from a small alphabet (many close
+    pairs), with some empty strings and some of 55 to 90 characters, so that
+    pairs fall on both sides of the 64 character limit of the fast path.
+    """
+    alphabet = u''.join(rng.choice(alphabets, rng.randint(1, len(alphabets) + 1), replace=False))
+    alphabet = alphabet[:rng.randint(2, 12)] if rng.uniform() < 0.5 else alphabet
+    words = [random_word(rng, alphabet, rng.randint(1, 12)) for _ in range(rng.randint(0, 40))]
+    words += [u''] * rng.randint(0, 3)
+    long_base = u''.join(rng.choice(list(alphabet), 90))
+    for _ in range(rng.randint(0, 6)):
+        # Long words, often edits of one another
+        word = list(long_base) if rng.uniform() < 0.7 else list(rng.choice(list(alphabet), 90))
+        for _ in range(rng.randint(0, 5)):
+            word[rng.randint(len(word))] = rng.choice(list(alphabet))
+        words.append(u''.join(word)[:rng.randint(55, 91)])
+    rng.shuffle(words)
+    return words
+
+def check(n_sets=200, seed=0):
+    """
+    Returns the number of word sets on which levenshteinMatrix and lDistance
+    disagree on some pair.
+    """
+    rng = np.random.RandomState(seed)
+    mismatches = 0
+    for k in range(n_sets):
+        words = random_words(rng)
+        distances = levenshteinMatrix(words)
+        bad = [(i, j) for i, j in itertools.combinations(range(len(words)), 2)
+               if distances[i, j] != lDistance(words[i], words[j])]
+        if bad or (len(words) and distances.diagonal().any()):
+            mismatches += 1
+            print('mismatch: set %d, %d words, pairs %r' % (k, len(words), bad[:5]))
+    return mismatches
+
+def benchmark(sizes=(300, 1000, 3000), loop_max=1000, seed=0):
+    """
+    Prints the seconds levenshteinMatrix and lDistance over all pairs take on
+    sets of distinct words of each size; lDistance is skipped above loop_max.
+    """
+    rng = np.random.RandomState(seed)
+    print('%8s %10s %12s %12s' % ('words', 'pairs', 'matrix', 'lDistance'))
+    for n in sizes:
+        words = set()
+        while len(words) < n:
+            words.add(random_word(rng, alphabets[0], 12))
+        words = list(words)
+        t0 = time.time()
+        levenshteinMatrix(words)
+        matrix = time.time() - t0
+        loop = float('nan')
+        if n <= loop_max:
+            t0 = time.time()
+            for first, second in itertools.combinations(words, 2):
+                lDistance(first, second)
+            loop = time.time() - t0
+        print('%8d %10d %12.4f %12.4f' % (n, n * (n - 1) // 2, matrix, loop))
+
+if __name__ == '__main__':
+    n_sets = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    mismatches = check(n_sets)
+    print('%d mismatches over %d word sets' % (mismatches, n_sets))
+    benchmark()
+    sys.exit(1 if mismatches else 0)
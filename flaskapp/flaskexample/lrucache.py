@@ -0,0 +1,77 @@
+"""
+A size-bounded LRU cache, shared by the tag cache of the NLP pipeline
+(textrank.TagCache) and the analysis result cache of the web app
+(views.ResultCache).
+"""
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """Thread-safe LRU cache of values, each put with its size in bytes.
+    Holds at most maxEntries values and, unless maxBytes is None, at most
+    maxBytes in total (the most recent value is always kept); the least
+    recently used are evicted first. Lookups and inserts are O(1).
+    A value put with a ttl expires ttl seconds later; looking it up after
+    that is a miss, and drops it.
+
+    metrics() reports entries, bytes held, hits, misses, hit rate, evictions
+    and expirations.
+    """
+
+    def __init__(self, maxEntries, maxBytes=None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Value of key, or None if not cached."""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[2] is not None and time.time() >= entry[2]:
+                self.bytes -= entry[1]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size, ttl=None):
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+            self._evict()
+
+    def resize(self, maxEntries):
+        with self.lock:
+            self.maxEntries = maxEntries
+            self._evict()
+
+    def _evict(self):
+        while len(self.entries) > self.maxEntries or \
+                (self.maxBytes is not None and self.bytes > self.maxBytes and len(self.entries) > 1):
+            self.bytes -= self.entries.popitem(last=False)[1][1]
+            self.evictions += 1
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'bytes': self.bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / float(lookups) if lookups else 0.0,
+                    'evictions': self.evictions, 'expirations': self.expirations}
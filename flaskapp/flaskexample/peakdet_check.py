@@ -0,0 +1,137 @@
+"""
+Regression check and benchmark for the vectorized peakdet in tweet_functions.
+
+Compares peakdet against a copy of the original per-element loop over random
+series (float and int, with plateaus, ties and NaNs), then times both across
+series lengths from 1e3 to 1e7. Run from this directory:
+
+    python peakdet_check.py [n_series]
+"""
+from __future__ import division, print_function
+import sys
+import time
+import numpy as np
+from tweet_functions import peakdet
+
+def peakdet_loop(v, delta):
+    """
+    The original peakdet from https://gist.github.com/endolith/250860, kept
+    as the reference implementation.
+    """
+    maxtab = []
+    mintab = []
+
+    x = np.arange(len(v))
+
+    v = np.asarray(v)
+
+    mn, mx = np.inf, -np.inf
+    mnpos, mxpos = np.nan, np.nan
+
+    lookformax = True
+
+    for i in np.arange(len(v)):
+        this = v[i]
+        if this > mx:
+            mx = this
+            mxpos = x[i]
+        if this < mn:
+            mn = this
+            mnpos = x[i]
+
+        if lookformax:
+            if this < mx - delta:
+                maxtab.append((mxpos, mx))
+                mn = this
+                mnpos = x[i]
+                lookformax = False
+        else:
+            if this > mn + delta:
+                mintab.append((mnpos, mn))
+                mx = this
+                mxpos = x[i]
+                lookformax = True
+
+    return np.array(maxtab), np.array(mintab)
+
+def random_series(rng):
+    """
+    A random series and delta: tweet-count-like integers (from quiet to busy),
+    rounded random walks with plateaus and ties, floats with NaNs sprinkled in,
+    or single precision floats.
+    """
+    n = rng.randint(0, 3000)
+    kind = rng.randint(4)
+    if kind == 0:
+        v = rng.poisson(np.exp(rng.uniform(np.log(0.1), np.log(50))), n)
+    elif kind == 1:
+        v = np.round(np.cumsum(rng.normal(size = n)), 1)
+    elif kind == 2:
+        v = np.cumsum(rng.normal(size = n))
+        v[rng.uniform(size = n) < rng.uniform(0, 0.05)] = np.nan
+    else:
+        v = np.cumsum(rng.normal(size = n)).astype(np.float32)
+    delta = rng.uniform(0, 3) * (np.nanstd(v) if n and not np.isnan(v).all() else 1)
+    return v, delta
+
+def same(a, b):
+    return a.shape == b.shape and np.array_equal(np.isnan(a), np.isnan(b)) and \
+        np.array_equal(a[~np.isnan(a)], b[~np.isnan(b)])
+
+def check(n_series=4000, seed=0):
+    """
+    Returns the number of series on which peakdet and peakdet_loop disagree.
+    """
+    rng = np.random.RandomState(seed)
+    mismatches = 0
+    for i in range(n_series):
+        v, delta = random_series(rng)
+        expected = peakdet_loop(v, delta)
+        found = peakdet(v, delta)
+        if not (same(np.asarray(found[0], float), np.asarray(expected[0], float)) and
+                same(np.asarray(found[1], float), np.asarray(expected[1], float))):
+            mismatches += 1
+            print('mismatch: series %d, length %d, delta %r' % (i, len(v), delta))
+    return mismatches
+
+def bursty_counts(rng, n):
+    """
+    Poisson background counts with a decaying burst every 20000 points on
+    average, like a hashtag's tweets per second around events.
+    """
+    v = rng.poisson(5, n)
+    for start in rng.randint(0, n, max(1, n // 20000)):
+        burst = rng.poisson(200 * np.exp(-np.arange(rng.randint(30, 600)) / 100))
+        v[start:start + len(burst)] += burst[:n - start]
+    return v
+
+def benchmark(lengths=(10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7), loop_max=10 ** 6, seed=0):
+    """
+    Prints the seconds peakdet and peakdet_loop take on bursty counts and on
+    plain Poisson noise at 0.5, 2 and 20 tweets per interval (a quiet to a busy
+    hashtag; phases switch every few dozen points, the worst case for peakdet)
+    of each length; the loop is skipped above loop_max.
+    """
+    rng = np.random.RandomState(seed)
+    print('%10s %8s %12s %12s' % ('length', 'series', 'vectorized', 'loop'))
+    for n in lengths:
+        series = [('bursty', bursty_counts(rng, n))] + \
+            [('noise%g' % rate, rng.poisson(rate, n)) for rate in (0.5, 2, 20)]
+        for name, v in series:
+            delta = max(v) * 0.25
+            t0 = time.time()
+            peakdet(v, delta)
+            vectorized = time.time() - t0
+            loop = float('nan')
+            if n <= loop_max:
+                t0 = time.time()
+                peakdet_loop(v, delta)
+                loop = time.time() - t0
+            print('%10d %8s %12.4f %12.4f' % (n, name, vectorized, loop))
+
+if __name__ == '__main__':
+    n_series = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    mismatches = check(n_series)
+    print('%d mismatches over %d series' % (mismatches, n_series))
+    benchmark()
+    sys.exit(1 if mismatches else 0)
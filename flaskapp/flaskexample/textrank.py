@@ -4,19 +4,27 @@ From github: https://github.com/davidadamojr/TextRank
 From this paper:
     https://web.eecs.umich.edu/~mihalcea/papers/mihalcea.emnlp04.pdf
 
-External dependencies: nltk, numpy, networkx
+External dependencies: nltk, numpy, scipy, networkx
 
 Based on https://gist.github.com/voidfiles/1646117
          https://github.com/davidadamojr/TextRank
 """
 
+import collections
+import hashlib
 import io
 import itertools
 import os
+import sys
+import time
 
 import click
 import networkx as nx
 import nltk
+import numpy as np
+import scipy.sparse
+
+from lrucache import LRUCache
 
 
 __version__ = '0.1.0'
@@ -29,6 +37,151 @@ def cli():
     pass
 
 
+class TagCache(LRUCache):
+    """LRU cache of POS tagged tokens, keyed by a SHA-1 hash of the text.
+    Holds at most maxEntries texts; the least recently used are evicted first.
+
+    metrics() reports entries, estimated bytes held, hits, misses, hit rate
+    and evictions, to tune maxEntries for big events.
+    """
+
+    def __init__(self, maxEntries=100000):
+        LRUCache.__init__(self, maxEntries)
+
+    @staticmethod
+    def key(text):
+        if isinstance(text, type(u'')):
+            text = text.encode('utf-8')
+        return hashlib.sha1(text).digest()
+
+    def get(self, text):
+        """Tagged tokens of text, or None if not cached."""
+        return LRUCache.get(self, self.key(text))
+
+    def put(self, text, tagged):
+        key = self.key(text)
+        size = sys.getsizeof(key) + sys.getsizeof(tagged) + \
+            sum(sys.getsizeof(pair) + sys.getsizeof(pair[0]) for pair in tagged)
+        LRUCache.put(self, key, tagged, size)
+
+
+class NLPPipeline(object):
+    """NLTK sentence splitter, word tokenizer and POS tagger, loaded once and
+    kept for the life of the process. nltk.pos_tag builds a new tagger (and
+    reloads its model) on every call; this loads it once in load().
+
+    tagStore, if set, is a persistent second level behind the tag cache, so
+    texts tagged by another process or an earlier run are not tagged again:
+    any object with get(texts), returning {text: tagged tokens} for the texts
+    it holds, and put(taggedByText).
+
+    metrics() reports the model load time and, per operation, the number of
+    calls, total seconds and mean latency, plus the tag cache metrics.
+    """
+
+    def __init__(self, cacheSize=100000, tagStore=None):
+        self.sentDetector = None
+        self.tagger = None
+        self.loadSeconds = 0.0
+        self.calls = {}
+        self.tagCache = TagCache(cacheSize)
+        self.tagStore = tagStore
+
+    def load(self):
+        if self.tagger is None:
+            from nltk.tag.perceptron import PerceptronTagger
+            start = time.time()
+            self.sentDetector = nltk.data.load('tokenizers/punkt/english.pickle')
+            self.tagger = PerceptronTagger()
+            self.loadSeconds = time.time() - start
+        return self
+
+    def _record(self, operation, start):
+        calls, seconds = self.calls.get(operation, (0, 0.0))
+        self.calls[operation] = (calls + 1, seconds + time.time() - start)
+
+    def tokenize(self, text):
+        """Word tokens of text, as nltk.word_tokenize."""
+        self.load()
+        start = time.time()
+        tokens = nltk.word_tokenize(text)
+        self._record('tokenize', start)
+        return tokens
+
+    def sentences(self, text):
+        self.load()
+        start = time.time()
+        sentenceTokens = self.sentDetector.tokenize(text)
+        self._record('sentences', start)
+        return sentenceTokens
+
+    def tag(self, tokens):
+        """(word, tag) pairs for tokens, as nltk.pos_tag."""
+        return self.tagBatch([tokens])[0]
+
+    def tagBatch(self, tokenLists):
+        """Tag many token lists in one call, as nltk.pos_tag_sents."""
+        self.load()
+        start = time.time()
+        tagged = self.tagger.tag_sents(tokenLists)
+        self._record('tag', start)
+        return tagged
+
+    def tagTexts(self, texts, tagStore=None):
+        """Tag a collection of short texts with many exact repeats, such as
+        retweets. Each distinct text is tokenized and tagged once, looked up
+        in the tag cache first, then in the tag store, and whatever is left is
+        tagged in one batch (and written back to the tag store).
+        tagStore overrides self.tagStore for this call.
+        Returns (tagged tokens of each distinct text in first-seen order,
+        number of times each occurs in texts).
+        """
+        if tagStore is None:
+            tagStore = self.tagStore
+        counts = collections.OrderedDict()
+        for text in texts:
+            counts[text] = counts.get(text, 0) + 1
+        distinct = list(counts)
+        tagged = [self.tagCache.get(text) for text in distinct]
+        missing = [i for i, x in enumerate(tagged) if x is None]
+        if missing and tagStore is not None:
+            start = time.time()
+            stored = tagStore.get([distinct[i] for i in missing])
+            self._record('tag_store_get', start)
+            for i in missing:
+                x = stored.get(distinct[i])
+                if x is not None:
+                    self.tagCache.put(distinct[i], x)
+                    tagged[i] = x
+            missing = [i for i in missing if tagged[i] is None]
+        if missing:
+            newTagged = self.tagBatch([self.tokenize(distinct[i]) for i in missing])
+            for i, x in zip(missing, newTagged):
+                self.tagCache.put(distinct[i], x)
+                tagged[i] = x
+            if tagStore is not None:
+                start = time.time()
+                tagStore.put(dict((distinct[i], x) for i, x in zip(missing, newTagged)))
+                self._record('tag_store_put', start)
+        return tagged, [counts[text] for text in distinct]
+
+    def metrics(self):
+        metrics = {'load_seconds': self.loadSeconds,
+                   'tag_cache': self.tagCache.metrics()}
+        for operation, (calls, seconds) in self.calls.items():
+            metrics[operation] = {'calls': calls, 'seconds': seconds,
+                                  'mean_ms': 1000.0 * seconds / calls}
+        return metrics
+
+
+_pipeline = NLPPipeline()
+
+
+def getPipeline():
+    """The NLPPipeline shared by everything in this process."""
+    return _pipeline
+
+
 # apply syntactic filters based on POS tags
 def filter_for_tags(tagged, tags=['NN', 'JJ', 'NNP']):
     return [item for item in tagged if item[1] in tags]
@@ -45,9 +198,10 @@ def unique_everseen(iterable, key=None):
     seen = set()
     seen_add = seen.add
     if key is None:
-        for element in [x for x in iterable if x not in seen]:
-            seen_add(element)
-            yield element
+        for element in iterable:
+            if element not in seen:
+                seen_add(element)
+                yield element
     else:
         for element in iterable:
             k = key(element)
@@ -76,93 +230,304 @@ def lDistance(firstString, secondString):
     return distances[-1]
 
 
-def buildGraph(nodes):
-    """nodes - list of hashables that represents the nodes of the graph"""
+def pairBatches(n, batchSize):
+    """Index arrays (first, second) for all pairs first < second of range(n),
+    in itertools.combinations order, yielded about batchSize pairs at a time.
+    """
+    row = 0
+    while row < n - 1:
+        end, size = row, 0
+        while end < n - 1 and size < batchSize:
+            size += n - 1 - end
+            end += 1
+        rows = np.arange(row, end)
+        counts = n - 1 - rows
+        first = np.repeat(rows, counts)
+        second = np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts) + first + 1
+        yield first, second
+        row = end
+
+
+def levenshteinMatrix(strings, batchSize=2 ** 18):
+    """Levenshtein distances between all pairs of strings, as a symmetric
+    numpy array. Uses Myers' bit-parallel algorithm (Hyyro's formulation for
+    edit distance), vectorized over batches of pairs: the shorter string of a
+    pair is the bit pattern, and each step consumes one character of the
+    longer one. Pairs whose shorter string exceeds 64 characters fall back to
+    lDistance. Gives the same distances as lDistance.
+    """
+    n = len(strings)
+    distances = np.zeros((n, n), dtype=np.int32)
+    if n < 2:
+        return distances
+
+    # Pack the strings into a padded array of character ids; the padding id
+    # has no bits set in any pattern mask
+    alphabet = {}
+    lengths = np.array([len(x) for x in strings], dtype=np.int64)
+    width = max(lengths.max(), 1)
+    chars = np.zeros((n, width), dtype=np.int64)
+    for i, string in enumerate(strings):
+        chars[i, :len(string)] = [alphabet.setdefault(c, len(alphabet) + 1) for c in string]
+    # masks[i, c] has bit r set if strings[i][r] is character c
+    masks = np.zeros((n, len(alphabet) + 1), dtype=np.uint64)
+    for i, string in enumerate(strings):
+        for r, c in enumerate(string[:64]):
+            masks[i, alphabet[c]] |= np.uint64(1) << np.uint64(r)
+
+    one = np.uint64(1)
+    for a, b in pairBatches(n, batchSize):
+        swap = lengths[a] > lengths[b]
+        pattern, text = np.where(swap, b, a), np.where(swap, a, b)
+        m, textLength = lengths[pattern], lengths[text]
+        fast = m <= 64
+        pattern, text, m, textLength = pattern[fast], text[fast], m[fast], textLength[fast]
+
+        Pv = np.full(len(pattern), ~np.uint64(0), dtype=np.uint64)
+        Mv = np.zeros(len(pattern), dtype=np.uint64)
+        score = m.copy()
+        # Empty patterns never change score; their distance is the text length
+        highBit = np.where(m > 0, one << np.maximum(m - 1, 0).astype(np.uint64), np.uint64(0))
+        for k in range(textLength.max() if len(text) else 0):
+            active = k < textLength
+            Eq = masks[pattern, chars[text, k]]
+            Xv = Eq | Mv
+            Xh = (((Eq & Pv) + Pv) ^ Pv) | Eq
+            Ph = Mv | ~(Xh | Pv)
+            Mh = Pv & Xh
+            score += active & ((Ph & highBit) != 0)
+            score -= active & ((Mh & highBit) != 0)
+            Ph = (Ph << one) | one
+            Mh = Mh << one
+            Pv = Mh | ~(Xv | Ph)
+            Mv = Ph & Xv
+        score = np.where(m == 0, textLength, score)
+        distances[a[fast], b[fast]] = score
+
+        for i, j in zip(a[~fast], b[~fast]):
+            distances[i, j] = lDistance(strings[i], strings[j])
+
+    return distances + distances.T
+
+
+def buildGraph(nodes, distances=None):
+    """nodes - list of hashables that represents the nodes of the graph
+    distances - edge weights as from levenshteinMatrix(nodes), computed if
+    not given
+    """
     gr = nx.Graph()  # initialize an undirected graph
     gr.add_nodes_from(nodes)
-    nodePairs = list(itertools.combinations(nodes, 2))
 
-    # add edges to the graph (weighted by Levenshtein distance)
-    for pair in nodePairs:
-        firstString = pair[0]
-        secondString = pair[1]
-        levDistance = lDistance(firstString, secondString)
-        gr.add_edge(firstString, secondString, weight=levDistance)
+    # add edges to the graph (weighted by Levenshtein distance), in the same
+    # order as itertools.combinations(nodes, 2)
+    if distances is None:
+        distances = levenshteinMatrix(nodes)
+    if scipy.sparse.issparse(distances):
+        edges = scipy.sparse.triu(distances, 1).tocoo()
+        gr.add_weighted_edges_from(zip([nodes[i] for i in edges.row], [nodes[j] for j in edges.col],
+                                       edges.data.tolist()))
+        return gr
+    for i, firstString in enumerate(nodes):
+        gr.add_weighted_edges_from((firstString, secondString, levDistance) for secondString, levDistance
+                                   in zip(nodes[i + 1:], distances[i, i + 1:].tolist()))
 
     return gr
 
 
-def extractKeyphrases(text):
-    # tokenize the text using nltk
-    wordTokens = nltk.word_tokenize(text)
+def tokenNodeIds(tagged, nodes):
+    """For each (word, tag) token of the text, the index in nodes of its
+    normalized word if it passes filter_for_tags, and -1 otherwise.
+    """
+    nodeIndex = dict((node, i) for i, node in enumerate(nodes))
+    normalized = normalize(tagged)
+    candidates = set(filter_for_tags(normalized))
+    return np.array([nodeIndex[item[0]] if item in candidates else -1
+                     for item in normalized], dtype=np.int64)
+
+
+def cooccurrenceMatrix(tokenIds, n, window=2, weights=None):
+    """Symmetric scipy.sparse matrix counting how often two of the n nodes
+    occur within a window of `window` consecutive tokens (window=2 links
+    adjacent tokens only), as in the Mihalcea paper.
+    tokenIds - node index of each token in the text, -1 for non-nodes
+    weights - how many times each token counts, 1 each by default; a
+        co-occurrence counts as the smaller weight of its two tokens
+    The number of edges grows linearly with the length of the text.
+    """
+    tokenIds = np.asarray(tokenIds)
+    if weights is None:
+        weights = np.ones(len(tokenIds))
+    rows, cols = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    data = [np.zeros(0)]
+    for offset in range(1, window):
+        first, second = tokenIds[:-offset], tokenIds[offset:]
+        keep = (first >= 0) & (second >= 0) & (first != second)
+        rows.append(first[keep])
+        cols.append(second[keep])
+        data.append(np.minimum(weights[:-offset], weights[offset:])[keep])
+    rows, cols, data = np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
+    counts = scipy.sparse.coo_matrix((data, (rows, cols)), shape=(n, n)).tocsr()
+    return counts + counts.T
+
+
+def pagerankNetworkx(nodes, adjacency):
+    """PageRank through networkx, on the graph built by buildGraph."""
+    return nx.pagerank(buildGraph(nodes, adjacency), weight='weight')
+
+
+def pagerankMatrix(nodes, adjacency, alpha=0.85, max_iter=100, tol=1.0e-6):
+    """PageRank by power iteration directly on a symmetric weighted adjacency
+    matrix (numpy array or scipy.sparse matrix). Follows nx.pagerank: same
+    damping, uniform start and teleport vectors, dangling nodes spread
+    uniformly, and stops once the l1 change is below len(nodes) * tol.
+    Returns {node: score} like nx.pagerank.
+    """
+    N = len(nodes)
+    if N == 0:
+        return {}
+    outWeight = np.asarray(adjacency.sum(axis=1), dtype=float).ravel()
+    dangling = outWeight == 0
+    scale = np.where(dangling, 0, 1.0 / np.where(dangling, 1, outWeight))
+
+    x = np.full(N, 1.0 / N)
+    for _ in range(max_iter):
+        xlast = x
+        danglesum = alpha * xlast[dangling].sum()
+        x = alpha * np.asarray(adjacency.T.dot(xlast * scale)).ravel() + \
+            danglesum / N + (1.0 - alpha) / N
+        if np.abs(x - xlast).sum() < N * tol:
+            return dict(zip(nodes, x.tolist()))
+    raise nx.NetworkXError('pagerank: power iteration failed to converge '
+                           'in %d iterations.' % max_iter)
+
+
+# ranking backends take (nodes, adjacency) and return {node: score}
+rankingBackends = {
+    'matrix': pagerankMatrix,
+    'networkx': pagerankNetworkx,
+}
+
+
+def extractKeyphrases(text, ranking='matrix', graph='levenshtein', window=2):
+    """ranking - key of rankingBackends used to score the words
+    graph - 'levenshtein' links every pair of candidate words, weighted by
+        edit distance; 'cooccurrence' links candidate words that occur within
+        `window` tokens of each other, weighted by how often they do
+    """
+    return extractKeyphrasesBatch([text], ranking, graph, window)[0]
+
+
+def extractKeyphrasesBatch(texts, ranking='matrix', graph='levenshtein', window=2):
+    """extractKeyphrases for many texts, POS tagging all of them in a single
+    batched call of the shared pipeline."""
+    pipeline = getPipeline()
+    # tokenize the texts using nltk
+    tokenLists = [pipeline.tokenize(text) for text in texts]
 
-    # assign POS tags to the words in the text
-    tagged = nltk.pos_tag(wordTokens)
-    textlist = [x[0] for x in tagged]
+    # assign POS tags to the words in the texts
+    return [keyphrasesFromTagged(allTagged, ranking, graph, window)
+            for allTagged in pipeline.tagBatch(tokenLists)]
+
+
+def extractKeyphrasesTweets(tweets, ranking='matrix', graph='levenshtein', window=2):
+    """extractKeyphrases for many short texts, such as the tweets of one peak.
+    Instead of tagging '.'.join(tweets), each distinct tweet is tagged once
+    (see NLPPipeline.tagTexts), the distinct tweets are joined by '.'
+    tokens, and every token is weighted by how often its tweet occurs.
+    """
+    taggedTexts, multiplicity = getPipeline().tagTexts(tweets)
+    separator = [('.', '.')]
+    allTagged = list(itertools.chain.from_iterable(tagged + separator for tagged in taggedTexts))[:-1]
+    weights = np.repeat(multiplicity, [len(tagged) + 1 for tagged in taggedTexts])[:len(allTagged)]
+    return keyphrasesFromTagged(allTagged, ranking, graph, window, weights)
 
-    tagged = filter_for_tags(tagged)
+
+def keyphrasesFromTagged(allTagged, ranking='matrix', graph='levenshtein', window=2,
+                         weights=None):
+    """The rest of extractKeyphrases, from the (word, tag) tokens of a text.
+    weights - how many times each token counts, 1 each by default
+    """
+    textlist = [x[0] for x in allTagged]
+
+    tagged = filter_for_tags(allTagged)
     tagged = normalize(tagged)
 
-    unique_word_set = unique_everseen([x[0] for x in tagged])
-    word_set_list = list(unique_word_set)
+    # one graph node per distinct candidate word
+    word_set_list = [x[0] for x in tagged]
+    nodes = list(unique_everseen(word_set_list))
 
     # this will be used to determine adjacent words in order to construct
     # keyphrases with two words
 
-    graph = buildGraph(word_set_list)
+    tokenIds = tokenNodeIds(allTagged, nodes)
+    if graph == 'cooccurrence':
+        adjacency = cooccurrenceMatrix(tokenIds, len(nodes), window, weights)
+    else:
+        adjacency = levenshteinMatrix(nodes)
 
     # pageRank - initial value of 1.0, error tolerance of 0,0001,
-    calculated_page_rank = nx.pagerank(graph, weight='weight')
+    calculated_page_rank = rankingBackends[ranking](nodes, adjacency)
 
     # most important words in ascending order of importance
     keyphrases = sorted(calculated_page_rank, key=calculated_page_rank.get,
                         reverse=True)
 
     # the number of keyphrases returned will be relative to the size of the
-    # text (a third of the number of vertices)
-    aThird = len(word_set_list) // 3
+    # text (a third of the number of candidate words, repeats included)
+    if weights is None:
+        aThird = len(word_set_list) // 3
+    else:
+        aThird = int(np.sum(weights[tokenIds >= 0])) // 3
     keyphrases = keyphrases[0:aThird + 1]
 
-    # take keyphrases with multiple words into consideration as done in the
-    # paper - if two words are adjacent in the text and are selected as
-    # keywords, join them together
+    return mergeKeyphrases(textlist, keyphrases, calculated_page_rank)
+
+
+def mergeKeyphrases(textlist, keyphrases, scores):
+    """Take keyphrases with multiple words into consideration as done in the
+    paper - if two words are adjacent in textlist and are both keyphrases,
+    join them together, scored by the sum of their scores. Keyphrases never
+    joined (up to the point they appear) are kept as single words.
+    Returns {keyphrase: score}.
+    """
+    keyphraseSet = set(keyphrases)
+    isKeyphrase = np.array([word in keyphraseSet for word in textlist], dtype=bool)
+    # isPair[i] - textlist[i] and textlist[i + 1] are both keyphrases
+    isPair = isKeyphrase[:-1] & isKeyphrase[1:]
+
     modifiedKeyphrases = {}
     # keeps track of individual keywords that have been joined to form a
     # keyphrase
     # Eli - modified to preserve scores for return value
-    dealtWith = set([])
-    i = 0
-    j = 1
-    while j < len(textlist):
+    dealtWith = set()
+    for i in np.flatnonzero(isKeyphrase[:-1]):
         firstWord = textlist[i]
-        secondWord = textlist[j]
-        if firstWord in keyphrases and secondWord in keyphrases:
+        if isPair[i]:
+            secondWord = textlist[i + 1]
             keyphrase = firstWord + ' ' + secondWord
-            modifiedKeyphrases[keyphrase] = calculated_page_rank[firstWord] + calculated_page_rank[secondWord]
+            modifiedKeyphrases[keyphrase] = scores[firstWord] + scores[secondWord]
             dealtWith.add(firstWord)
             dealtWith.add(secondWord)
-        else:
-            if firstWord in keyphrases and firstWord not in dealtWith:
-                modifiedKeyphrases[firstWord] = calculated_page_rank[firstWord]
-
-            # if this is the last word in the text, and it is a keyword, it
-            # definitely has no chance of being a keyphrase at this point
-            if j == len(textlist) - 1 and secondWord in keyphrases and \
-                    secondWord not in dealtWith:
-                modifiedKeyphrases[secondWord] = calculated_page_rank[secondWord]
+        elif firstWord not in dealtWith:
+            modifiedKeyphrases[firstWord] = scores[firstWord]
 
-        i = i + 1
-        j = j + 1
+    # if the last word in the text is a keyword, it definitely has no chance
+    # of being a keyphrase at this point
+    if len(textlist) > 1 and isKeyphrase[-1] and not isPair[-1] and \
+            textlist[-1] not in dealtWith:
+        modifiedKeyphrases[textlist[-1]] = scores[textlist[-1]]
 
     return modifiedKeyphrases
 
 
-def extractSentences(text):
-    sent_detector = nltk.data.load('tokenizers/punkt/english.pickle')
-    sentenceTokens = sent_detector.tokenize(text.strip())
-    graph = buildGraph(sentenceTokens)
+def extractSentences(text, ranking='matrix'):
+    """ranking - key of rankingBackends used to score the sentences"""
+    sentenceTokens = getPipeline().sentences(text.strip())
+    # one graph node per distinct sentence
+    nodes = list(unique_everseen(sentenceTokens))
+    distances = levenshteinMatrix(nodes)
 
-    calculated_page_rank = nx.pagerank(graph, weight='weight')
+    calculated_page_rank = rankingBackends[ranking](nodes, distances)
 
     # most important sentences in ascending order of importance
     sentences = sorted(calculated_page_rank, key=calculated_page_rank.get,
@@ -214,5 +579,25 @@ def summarize(filename):
         print(summary)
 
 
+@cli.command()
+@click.argument('filename')
+@click.option('--window', default=2, help='Co-occurrence window in tokens.')
+@click.option('--top', default=10, help='Number of top keyphrases to compare.')
+def compare_graphs(filename, window, top):
+    """Compare runtime and top keyphrases of the all-pairs Levenshtein graph
+    and the co-occurrence graph on one text."""
+    with open(filename) as fin:
+        text = fin.read()
+    topKeyphrases = {}
+    for graph in ['levenshtein', 'cooccurrence']:
+        start = time.time()
+        keyphrases = extractKeyphrases(text, graph=graph, window=window)
+        elapsed = time.time() - start
+        topKeyphrases[graph] = sorted(keyphrases, key=keyphrases.get, reverse=True)[:top]
+        print('%s: %.3f s, top %d: %s' % (graph, elapsed, top, ', '.join(topKeyphrases[graph])))
+    shared = set(topKeyphrases['levenshtein']) & set(topKeyphrases['cooccurrence'])
+    print('top %d agreement: %d/%d' % (top, len(shared), top))
+
+
 if __name__ == '__main__':
     cli()
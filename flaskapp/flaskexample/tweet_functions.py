@@ -3,31 +3,463 @@ import tweepy
 import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import sqlite3
 import datetime
+import binascii
+import bisect
+import collections
+import contextlib
+import io
+import json
+import random
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
 import re
+import sys
 import textrank
 import time
+import multiprocessing
+import multiprocessing.pool
+import threading
 import matplotlib.dates as mdates
 import matplotlib as mpl
 mpl.rcParams['font.family'] = 'Arial'
 
 
-def tweet_to_db(searchQuery, start, end, tweetsPerQry=100, maxTweets=100000000):
+def _is_sqlite(con):
+    return isinstance(con, sqlite3.Connection)
+
+def _sql(con, query):
     """
-    This function pulls tweets with hashtag searchQuery from a specified time period.
-    tweetsPerQry = 100 is the maximal number of tweets allowed by Twitter per query.
-    maxTweets is some arbitrary big number.
-    Tweets are instantly inserted into an SQL database with one table 'tweets',
-    which has the following 4 columns:
+    Queries are written in psycopg2's paramstyle (%s);
+    convert them for SQLite connections, which expect ?.
+    """
+    if _is_sqlite(con):
+        return query.replace('%s', '?')
+    return query
+
+def _db_time(con, t):
+    """
+    Timestamps are passed to psycopg2 as datetimes. SQLite has no native
+    timestamp type, so they are stored and compared as '%Y-%m-%d %H:%M:%S' text.
+    """
+    if _is_sqlite(con):
+        return t.strftime('%Y-%m-%d %H:%M:%S')
+    return t
+
+_rds_keys = None
+
+def _rds_connect_args():
+    """
+    Connection arguments for the RDS Postgres instance listed in rds_keys.txt,
+    read once per process.
+    """
+    global _rds_keys
+    if _rds_keys is None:
+        with open('/home/ubuntu/rds_keys.txt') as rds_keys:
+            keys = rds_keys.readlines()
+        host, dbname, rds_user, rds_pw = [x.strip() for x in keys]
+        _rds_keys = dict(host = host, dbname = dbname, user = rds_user, password = rds_pw, port = '5432')
+    return _rds_keys
+
+def connect_db():
+    """
+    Open a connection to the RDS Postgres instance listed in rds_keys.txt.
+    For short-lived use prefer pooled_connection().
+    """
+    return psycopg2.connect(**_rds_connect_args())
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def db_pool(maxconn=16):
+    """
+    Thread-safe pool of connections to the RDS instance, shared by everything in
+    this process and created on first use. Connections are opened as needed, up
+    to maxconn at once. Processes started after the pool exists must not use it.
+    """
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(1, maxconn, **_rds_connect_args())
+    return _db_pool
+
+@contextlib.contextmanager
+def pooled_connection():
+    """
+    Borrow a connection from db_pool() for the duration of a with block.
+    Uncommitted work is rolled back before the connection goes back to the pool.
+    """
+    pool = db_pool()
+    con = pool.getconn()
+    try:
+        yield con
+    finally:
+        if not con.closed:
+            con.rollback()
+        pool.putconn(con)
+
+def _column_type(con, table, column):
+    cur = con.cursor()
+    cur.execute("SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+                [table, column])
+    return cur.fetchone()[0].lower()
+
+def _index_exists(con, index_name):
+    cur = con.cursor()
+    if _is_sqlite(con):
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", [index_name])
+    else:
+        cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [index_name])
+    return cur.fetchone() is not None
+
+def create_tweets_table(con):
+    """
+    Create table 'tweets' if it does not exist yet, and migrate existing tables.
+    con can be a psycopg2 connection or a sqlite3 connection (local stand-in).
+
+    Migrations:
+    tweets_hashtag_tweet_id_key - unique index on (hashtag, tweet_id), so that
+        duplicates are rejected by the db. Rows duplicated before the index
+        existed are dropped (the copy with the lowest id is kept).
+    datetime - converted from TEXT to TIMESTAMP (Postgres only; SQLite keeps
+        the text, which sorts in time order).
+    tweets_hashtag_datetime_idx - index on (hashtag, datetime) for time-range queries.
+    """
+    if _is_sqlite(con):
+        id_column = 'id INTEGER PRIMARY KEY'
+    else:
+        id_column = 'id SERIAL PRIMARY KEY'
+    create_table = """
+    CREATE TABLE IF NOT EXISTS tweets (%s, tweet_id BIGINT, hashtag TEXT,
+    datetime TIMESTAMP, content TEXT);
+    """ % id_column
+    cur = con.cursor()
+    cur.execute(create_table)
+    if not _index_exists(con, 'tweets_hashtag_tweet_id_key'):
+        cur.execute("""
+        DELETE FROM tweets WHERE id NOT IN
+        (SELECT MIN(id) FROM tweets GROUP BY hashtag, tweet_id);
+        """)
+        cur.execute("CREATE UNIQUE INDEX tweets_hashtag_tweet_id_key ON tweets (hashtag, tweet_id);")
+    if not _is_sqlite(con) and _column_type(con, 'tweets', 'datetime') == 'text':
+        cur.execute("ALTER TABLE tweets ALTER COLUMN datetime TYPE TIMESTAMP USING datetime::timestamp;")
+    cur.execute("CREATE INDEX IF NOT EXISTS tweets_hashtag_datetime_idx ON tweets (hashtag, datetime);")
+    con.commit()
+
+def create_tagged_texts_table(con):
+    """
+    Create table 'tagged_texts' if it does not exist yet. It holds the POS tagged
+    tokens of cleaned tweet texts, which has the following 2 columns:
+    text_hash - TEXT, hex SHA-1 of the cleaned text (primary key)
+    tagged - TEXT, the (word, tag) tokens written as 'word/TAG', separated by spaces
+    """
+    cur = con.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS tagged_texts (text_hash TEXT PRIMARY KEY, tagged TEXT);")
+    con.commit()
+
+def tagged_to_text(tagged):
+    """
+    Write (word, tag) tokens as one string, 'word/TAG' separated by spaces.
+    Tokens never contain spaces, and tags never contain '/'.
+    """
+    return ' '.join('%s/%s' % (word, tag) for word, tag in tagged)
+
+def text_to_tagged(text):
+    """
+    Inverse of tagged_to_text.
+    """
+    if not text:
+        return []
+    return [tuple(token.rsplit('/', 1)) for token in text.split(' ')]
+
+class TaggedTextStore(object):
+    """
+    Tagged tokens of cleaned tweet texts, persisted in table 'tagged_texts'.
+    Used as the tagStore of textrank's NLP pipeline (see use_tag_store), so a
+    text tagged once - at ingest, or by an earlier analysis of an overlapping
+    window - is read back instead of being tokenized and tagged again.
+    """
+    batch_size = 500
+
+    def __init__(self, con=None):
+        if con is None:
+            con = connect_db()
+        self.con = con
+        create_tagged_texts_table(con)
+
+    @staticmethod
+    def text_hash(text):
+        return binascii.hexlify(textrank.TagCache.key(text))
+
+    def get(self, texts):
+        """
+        Dict of text: tagged tokens, for the texts in the store.
+        On Postgres, the transaction the lookup opens is ended again, unless
+        the caller already had one open; SQLite does not open one to read.
+        """
+        texts_by_hash = dict((self.text_hash(text), text) for text in texts)
+        hashes = list(texts_by_hash)
+        found = {}
+        own_transaction = not _is_sqlite(self.con) and \
+            self.con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        cur = self.con.cursor()
+        for i in range(0, len(hashes), self.batch_size):
+            batch = hashes[i:i + self.batch_size]
+            select_tagged = "SELECT text_hash, tagged FROM tagged_texts WHERE text_hash IN (%s)" \
+                % ', '.join(['%s'] * len(batch))
+            cur.execute(_sql(self.con, select_tagged), batch)
+            for text_hash, tagged in cur.fetchall():
+                found[texts_by_hash[text_hash]] = text_to_tagged(tagged)
+        if own_transaction:
+            # Don't leave a long-lived store connection idle in transaction
+            self.con.rollback()
+        return found
+
+    def put(self, tagged_by_text):
+        """
+        Store a dict of text: tagged tokens. Texts already stored are skipped.
+        """
+        rows = [(self.text_hash(text), tagged_to_text(tagged))
+                for text, tagged in tagged_by_text.items()]
+        if not rows:
+            return
+        cur = self.con.cursor()
+        if _is_sqlite(self.con):
+            cur.executemany("""
+            INSERT INTO tagged_texts(text_hash, tagged) VALUES (?, ?)
+            ON CONFLICT (text_hash) DO NOTHING
+            """, rows)
+        else:
+            psycopg2.extras.execute_values(cur, """
+            INSERT INTO tagged_texts(text_hash, tagged) VALUES %s
+            ON CONFLICT (text_hash) DO NOTHING
+            """, rows, page_size=len(rows))
+        self.con.commit()
+
+def use_tag_store(con=None):
+    """
+    Read and write tagged texts through a TaggedTextStore on con in this process,
+    so that analyses skip tokenizing and tagging tweets already tagged at ingest
+    or by earlier runs. Without con, the store already in use is kept, or one is
+    opened on a new connection of its own.
+    """
+    pipeline = textrank.getPipeline()
+    if con is not None or pipeline.tagStore is None:
+        pipeline.tagStore = TaggedTextStore(con)
+    return pipeline.tagStore
+
+@contextlib.contextmanager
+def pooled_tag_store():
+    """
+    Use a TaggedTextStore on a connection borrowed from db_pool() for the
+    duration of a with block (see use_tag_store); the store used before is
+    restored afterwards.
+    """
+    pipeline = textrank.getPipeline()
+    previous = pipeline.tagStore
+    with pooled_connection() as con:
+        pipeline.tagStore = TaggedTextStore(con)
+        try:
+            yield pipeline.tagStore
+        finally:
+            pipeline.tagStore = previous
+
+# Tagging shares the process-wide NLP pipeline and its cache between ingest threads
+_tag_lock = threading.Lock()
+
+def insert_tweets(con, rows, bulk=True):
+    """
+    Write a batch of rows [tweet_id, hashtag, datetime, content] into 'tweets'.
+    Tweets already stored for the same hashtag are skipped by the db.
+    With bulk=True the batch is sent as one multi-row INSERT (executemany on SQLite),
+    otherwise as one INSERT per row.
+    Does not commit; the caller decides how often to commit.
+    """
+    if not rows:
+        return
+    insert_tweet = """
+    INSERT INTO tweets(tweet_id, hashtag, datetime, content) VALUES (%s, %s, %s, %s)
+    ON CONFLICT (hashtag, tweet_id) DO NOTHING
+    """
+    cur = con.cursor()
+    if not bulk:
+        for row in rows:
+            cur.execute(_sql(con, insert_tweet), row)
+    elif _is_sqlite(con):
+        cur.executemany(_sql(con, insert_tweet), rows)
+    else:
+        insert_values = """
+        INSERT INTO tweets(tweet_id, hashtag, datetime, content) VALUES %s
+        ON CONFLICT (hashtag, tweet_id) DO NOTHING
+        """
+        psycopg2.extras.execute_values(cur, insert_values, rows, page_size=len(rows))
+
+def create_coverage_table(con):
+    """
+    Create table 'tweet_coverage' if it does not exist yet. Each row is a span of
+    time for which all tweets of a hashtag are in 'tweets':
     id - unique identifier
-    tweet_id - BIGINT, unique tweet id
-    datetime - TEXT, datetime in format '%Y-%m-%d %H:%M:%S'
-    content - TEXT, tweet content
+    hashtag - TEXT
+    start_time, end_time - TIMESTAMP, the span covered
+    min_id, max_id - BIGINT, tweet ids bounding the span (NULL if it has no tweets)
+    """
+    if _is_sqlite(con):
+        id_column = 'id INTEGER PRIMARY KEY'
+    else:
+        id_column = 'id SERIAL PRIMARY KEY'
+    cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tweet_coverage (%s, hashtag TEXT,
+    start_time TIMESTAMP, end_time TIMESTAMP, min_id BIGINT, max_id BIGINT);
+    """ % id_column)
+    cur.execute("CREATE INDEX IF NOT EXISTS tweet_coverage_hashtag_idx ON tweet_coverage (hashtag, start_time);")
+    con.commit()
+
+def _from_db_time(con, t):
+    """
+    Inverse of _db_time.
+    """
+    if _is_sqlite(con):
+        return datetime.datetime.strptime(t, '%Y-%m-%d %H:%M:%S')
+    return t
+
+select_coverage = """
+SELECT id, start_time, end_time, min_id, max_id FROM tweet_coverage
+WHERE hashtag = %s AND end_time >= %s AND start_time <= %s ORDER BY start_time
+"""
+
+def coverage_spans(con, hashtag, start, end):
+    """
+    Covered spans [(start_time, end_time, min_id, max_id)] of hashtag that overlap
+    or touch [start, end], in time order.
+    """
+    cur = con.cursor()
+    cur.execute(_sql(con, select_coverage), [hashtag, _db_time(con, start), _db_time(con, end)])
+    return [(_from_db_time(con, span_start), _from_db_time(con, span_end), min_id, max_id)
+            for span_id, span_start, span_end, min_id, max_id in cur.fetchall()]
+
+def coverage_gaps(con, hashtag, start, end):
+    """
+    The parts of [start, end] not covered by tweet_coverage, as a time-ordered
+    list of (gap_start, gap_end).
+    """
+    gaps = []
+    covered_until = start
+    for span_start, span_end, min_id, max_id in coverage_spans(con, hashtag, start, end):
+        if span_start > covered_until:
+            gaps.append((covered_until, span_start))
+        covered_until = max(covered_until, span_end)
+        if covered_until >= end:
+            break
+    if covered_until < end:
+        gaps.append((covered_until, end))
+    return gaps
+
+# Tweets can take this long to show up in search results; the most recent part
+# of a window is never recorded as covered, so later calls fetch it again
+search_index_lag = datetime.timedelta(minutes=5)
+
+def record_coverage(con, hashtag, start, end, min_id, max_id):
+    """
+    Record [start, end] as fully ingested for hashtag. Spans it overlaps or
+    touches are merged with it into one row, so each hashtag keeps a few
+    disjoint spans. Does not commit.
+    """
+    cur = con.cursor()
+    span_ids = []
+    ids = [x for x in [min_id, max_id] if x is not None]
+    while True:
+        cur.execute(_sql(con, select_coverage), [hashtag, _db_time(con, start), _db_time(con, end)])
+        spans = [span for span in cur.fetchall() if span[0] not in span_ids]
+        if not spans:
+            break
+        # A merged span can reach further spans, so look again until nothing is added
+        for span_id, span_start, span_end, span_min_id, span_max_id in spans:
+            span_ids.append(span_id)
+            start = min(start, _from_db_time(con, span_start))
+            end = max(end, _from_db_time(con, span_end))
+            ids.extend(x for x in [span_min_id, span_max_id] if x is not None)
+    for span_id in span_ids:
+        cur.execute(_sql(con, "DELETE FROM tweet_coverage WHERE id = %s"), [span_id])
+    cur.execute(_sql(con, """
+    INSERT INTO tweet_coverage(hashtag, start_time, end_time, min_id, max_id)
+    VALUES (%s, %s, %s, %s, %s)
+    """), [hashtag, _db_time(con, start), _db_time(con, end),
+           min(ids) if ids else None, max(ids) if ids else None])
+
+# Resolutions (in seconds) of the tweet count rollups
+rollup_resolutions = [1, 10, 60, 600]
+
+def create_rollup_table(con):
+    """
+    Create table 'tweet_counts' if it does not exist yet. It holds the number of
+    tweets of each hashtag per time bucket, at each of rollup_resolutions:
+    hashtag - TEXT
+    resolution - INTEGER, bucket length in seconds
+    bucket - TIMESTAMP, bucket start (a multiple of resolution since the epoch)
+    count - INTEGER, number of tweets; buckets without tweets have no row
+    """
+    cur = con.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS tweet_counts (hashtag TEXT, resolution INTEGER,
+    bucket TIMESTAMP, count INTEGER, PRIMARY KEY (hashtag, resolution, bucket));
+    """)
+    con.commit()
 
+def _floor_time(t, seconds):
+    """
+    Start of the seconds-long bucket (counted from the epoch) that t falls in.
+    """
+    epoch = datetime.datetime(1970, 1, 1)
+    delta = pd.Timestamp(t).to_pydatetime() - epoch
+    total = delta.days * 86400 + delta.seconds
+    return epoch + datetime.timedelta(seconds=total - total % seconds)
+
+def update_rollups(con, hashtag, start, end):
+    """
+    Recount, from table 'tweets', every rollup bucket of hashtag that overlaps
+    [start, end]. Only the tweets of those buckets are read, so tweet_to_db
+    keeps the rollups current at a cost in proportion to what it ingested.
+    Counts are upserted, so concurrent recounts of the same buckets do not
+    collide; tweets are never deleted, so no bucket goes back to zero.
+    Does not commit.
+    """
+    coarsest = max(rollup_resolutions)
+    first = _floor_time(start, coarsest)
+    stop = _floor_time(end, coarsest) + datetime.timedelta(seconds=coarsest)
+    cur = con.cursor()
+    cur.execute(_sql(con, "SELECT datetime FROM tweets WHERE hashtag = %s AND datetime >= %s AND datetime < %s"),
+                [hashtag, _db_time(con, first), _db_time(con, stop)])
+    times = pd.to_datetime([row[0] for row in cur.fetchall()])
+    seconds = ((times - pd.Timestamp(first)) // pd.Timedelta(seconds=1)).values.astype(int)
+    n_seconds = int((stop - first).total_seconds())
+    for resolution in rollup_resolutions:
+        counts = np.bincount(seconds // resolution, minlength=n_seconds // resolution)
+        buckets = np.flatnonzero(counts)
+        rows = [(hashtag, resolution, _db_time(con, first + datetime.timedelta(seconds=int(k) * resolution)),
+                 int(counts[k])) for k in buckets]
+        if not rows:
+            continue
+        if _is_sqlite(con):
+            cur.executemany("""
+            INSERT INTO tweet_counts(hashtag, resolution, bucket, count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (hashtag, resolution, bucket) DO UPDATE SET count = excluded.count
+            """, rows)
+        else:
+            psycopg2.extras.execute_values(cur, """
+            INSERT INTO tweet_counts(hashtag, resolution, bucket, count) VALUES %s
+            ON CONFLICT (hashtag, resolution, bucket) DO UPDATE SET count = EXCLUDED.count
+            """, rows, page_size=len(rows))
+
+def twitter_api():
+    """
+    tweepy.API for the Twitter search API, with the keys in twitter_oauth.txt.
     """
     # Obtain keys
     with open('/home/ubuntu/twitter_oauth.txt') as oauth:
@@ -37,17 +469,285 @@ def tweet_to_db(searchQuery, start, end, tweetsPerQry=100, maxTweets=100000000):
     # Replace the API_KEY and API_SECRET with your application's key and secret.
     auth = tweepy.AppAuthHandler(consumer_key, consumer_secret)
 
-    api = tweepy.API(auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+    # Rate limits are handled by RateLimitedAPI, which does not block on them
+    return tweepy.API(auth, wait_on_rate_limit=False)
 
-    startSince = start.strftime("%Y-%m-%d")
-    endUntil = (end + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+def _is_rate_limit_error(e):
+    """
+    True for the TweepError of a request rejected by the rate limit
+    (HTTP 429, Twitter error code 88).
+    """
+    response = getattr(e, 'response', None)
+    return getattr(e, 'api_code', None) == 88 or \
+        getattr(response, 'status_code', None) == 429
+
+class RateLimitedAPI(object):
+    """
+    Schedules the search calls of a search API (tweepy.API without
+    wait_on_rate_limit, or a ReplayAPI) by the quota it reports in the
+    x-rate-limit-remaining and x-rate-limit-reset headers of its last response.
+    Calls go out at once while more than reserve calls are left in the rate
+    window; only the last reserve calls are spread evenly over what is left of
+    it, and with none left calls wait for the reset. If the limit is hit anyway,
+    the call is retried after the reset. Other errors are retried with exponential
+    backoff and full jitter (a random delay of up to base_backoff * 2 ** attempt,
+    capped at max_backoff), at most max_retries times before the error is raised.
+
+    Can be shared by several threads: calls are paced across all of them, and
+    at most max_in_flight calls (None for no cap) are waiting on the API at once.
+
+    metrics() reports calls, errors, and the seconds lost to pacing and rate
+    limit waits (throttled_seconds) and to error backoff (backoff_seconds);
+    metrics(thread=True) only counts the calls made by the current thread.
+    """
+    def __init__(self, api, max_retries=5, base_backoff=1.0, max_backoff=300.0, max_in_flight=None,
+                 reserve=10):
+        self.api = api
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.next_call = 0
+        self.lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.totals = dict.fromkeys(['calls', 'errors', 'throttled_seconds', 'backoff_seconds'], 0)
+        self.local = threading.local()
+
+    def _count(self, key, value=1):
+        if not hasattr(self.local, 'totals'):
+            self.local.totals = dict.fromkeys(self.totals, 0)
+        self.local.totals[key] += value
+        with self.lock:
+            self.totals[key] += value
+
+    def quota(self):
+        """
+        (remaining calls, reset time in epoch seconds) from the last response,
+        or (None, None) if the API did not report them.
+        """
+        response = getattr(self.api, 'last_response', None)
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            return (int(headers['x-rate-limit-remaining']),
+                    float(headers['x-rate-limit-reset']))
+        except (KeyError, ValueError):
+            return None, None
+
+    def _pace(self):
+        """
+        Wait until the quota allows another call, and reserve its slot.
+        """
+        with self.lock:
+            remaining, reset = self.quota()
+            now = time.time()
+            if remaining is None or remaining > self.reserve:
+                # Burst while the quota covers it
+                wait = 0
+            elif remaining <= 0:
+                wait = reset - now
+            else:
+                wait = self.next_call - now
+            wait = max(wait, 0)
+            if remaining and remaining <= self.reserve:
+                self.next_call = now + wait + max(reset - now - wait, 0) / remaining
+        if wait > 0:
+            time.sleep(wait)
+            self._count('throttled_seconds', wait)
+
+    def _search(self, *args, **kwargs):
+        if self.in_flight is None:
+            return self.api.search(*args, **kwargs)
+        with self.in_flight:
+            return self.api.search(*args, **kwargs)
+
+    def search(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            self._pace()
+            self._count('calls')
+            try:
+                return self._search(*args, **kwargs)
+            except tweepy.TweepError as e:
+                self._count('errors')
+                remaining, reset = self.quota()
+                if _is_rate_limit_error(e) and reset is not None and reset > time.time():
+                    # Not a failure: _pace waits for the reset before the next call
+                    continue
+                if attempt >= self.max_retries:
+                    raise
+                wait = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+                time.sleep(wait)
+                self._count('backoff_seconds', wait)
+                attempt += 1
+
+    def metrics(self, thread=False):
+        if thread:
+            return dict(getattr(self.local, 'totals', dict.fromkeys(self.totals, 0)))
+        with self.lock:
+            return dict(self.totals)
+
+ReplayTweet = collections.namedtuple('ReplayTweet', ['id', 'created_at', 'text', 'lang'])
+ReplayResponse = collections.namedtuple('ReplayResponse', ['status_code', 'headers'])
+
+def _replay_time(created_at):
+    """
+    Tweet creation time from a JSONL record: Twitter's own format
+    ('Wed Jun 07 14:00:00 +0000 2017') or '%Y-%m-%d %H:%M:%S', both UTC.
+    """
+    try:
+        return datetime.datetime.strptime(created_at, '%a %b %d %H:%M:%S +0000 %Y')
+    except ValueError:
+        return datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+
+class ReplayAPI(object):
+    """
+    Stand-in for tweepy.API that answers search() from tweets stored in a JSONL
+    file, one tweet per line with id, created_at and text (or full_text), and
+    optionally lang - for instance tweets dumped as returned by the Twitter API.
+    Used to load-test tweet_to_db and the pipeline offline and reproducibly.
+
+    search() follows the Twitter search API: tweets containing q (case-insensitive),
+    newest first, at most count, with id <= max_id, created on or after since and
+    before until (both '%Y-%m-%d'), and in lang if given.
+    latency - seconds slept per search call, to mimic the network round trip.
+    rate_limit, rate_window - at most rate_limit calls per rate_window seconds
+        (450 per 15 min is Twitter's app-auth search limit); None for no limit.
+        Further calls wait for the window to free up, as tweepy.API does with
+        wait_on_rate_limit=True, or raise tweepy.TweepError if wait_on_rate_limit=False.
+    calls and throttled_seconds count search calls and the time spent waiting.
+    last_response carries the rate limit headers of the Twitter API
+    (x-rate-limit-remaining, x-rate-limit-reset), as tweepy.API.last_response does.
+    """
+    def __init__(self, path, latency=0, rate_limit=450, rate_window=900, wait_on_rate_limit=True):
+        tweets = []
+        with io.open(path, encoding='utf-8') as replay_file:
+            for line in replay_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                tweets.append(ReplayTweet(int(record.get('id_str', record.get('id'))),
+                                          _replay_time(record['created_at']),
+                                          record.get('full_text', record.get('text')),
+                                          record.get('lang')))
+        tweets.sort(key=lambda tweet: tweet.id)
+        self.tweets = tweets
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.wait_on_rate_limit = wait_on_rate_limit
+        self.call_times = collections.deque()
+        self.calls = 0
+        self.throttled_seconds = 0
+        self.last_response = None
+        self._matches = {}
+        self.lock = threading.Lock()
+
+    def _matching(self, q):
+        """
+        Tweets containing q and their ids, in id order, computed once per q.
+        """
+        if q not in self._matches:
+            q_lower = q.lower()
+            tweets = [tweet for tweet in self.tweets if q_lower in tweet.text.lower()]
+            self._matches[q] = (tweets, [tweet.id for tweet in tweets])
+        return self._matches[q]
+
+    def _throttle(self):
+        if self.rate_limit is None:
+            return
+        now = time.time()
+        while self.call_times and self.call_times[0] <= now - self.rate_window:
+            self.call_times.popleft()
+        if len(self.call_times) >= self.rate_limit:
+            wait = self.call_times[0] + self.rate_window - now
+            if not self.wait_on_rate_limit:
+                self.last_response = ReplayResponse(429, self._quota_headers())
+                raise tweepy.TweepError('Rate limit exceeded', self.last_response, 88)
+            time.sleep(wait)
+            self.throttled_seconds += wait
+            self.call_times.popleft()
+        self.call_times.append(time.time())
+
+    def _quota_headers(self):
+        if self.rate_limit is None:
+            return {}
+        return {'x-rate-limit-limit': str(self.rate_limit),
+                'x-rate-limit-remaining': str(self.rate_limit - len(self.call_times)),
+                'x-rate-limit-reset': str(self.call_times[0] + self.rate_window)}
+
+    def stream(self, q, start=None, end=None, speedup=None):
+        """
+        Tweets containing q, oldest first, created between start and end (inclusive),
+        as if they were arriving live. With speedup, each tweet is delayed until its
+        time comes on a clock running speedup times faster than real time.
+        """
+        tweets, ids = self._matching(q)
+        replay_start = time.time()
+        for tweet in tweets:
+            if start is not None and tweet.created_at < start:
+                continue
+            if end is not None and tweet.created_at > end:
+                break
+            if speedup:
+                if start is None:
+                    start = tweet.created_at
+                wait = (tweet.created_at - start).total_seconds() / speedup - (time.time() - replay_start)
+                if wait > 0:
+                    time.sleep(wait)
+            yield tweet
+
+    def search(self, q, count=15, lang=None, max_id=None, since=None, until=None, **kwargs):
+        with self.lock:
+            self._throttle()
+            self.calls += 1
+            self.last_response = ReplayResponse(200, self._quota_headers())
+            tweets, ids = self._matching(q)
+        if self.latency:
+            time.sleep(self.latency)
+        if max_id is None:
+            i = len(ids)
+        else:
+            i = bisect.bisect_right(ids, int(max_id))
+        since = datetime.datetime.strptime(since, '%Y-%m-%d') if since else None
+        until = datetime.datetime.strptime(until, '%Y-%m-%d') if until else None
+        results = []
+        while i > 0 and len(results) < count:
+            i -= 1
+            tweet = tweets[i]
+            if since is not None and tweet.created_at < since:
+                break
+            if until is not None and tweet.created_at >= until:
+                continue
+            if lang is not None and tweet.lang is not None and tweet.lang != lang:
+                continue
+            results.append(tweet)
+        return results
+
+twitter_epoch_ms = 1288834974657
+
+def snowflake_time(tweet_id):
+    """
+    Creation time (UTC, millisecond resolution) encoded in a snowflake tweet id:
+    the top 41 bits are milliseconds since the Twitter epoch.
+    """
+    return datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(milliseconds=(tweet_id >> 22) + twitter_epoch_ms)
+
+def snowflake_id(t):
+    """
+    Smallest snowflake id of a tweet created at t (UTC) or later.
+    """
+    delta = t - datetime.datetime(1970, 1, 1)
+    ms = delta.days * 86400000 + delta.seconds * 1000 + delta.microseconds // 1000
+    return (ms - twitter_epoch_ms) << 22
 
+def _bisect_end_id(api, searchQuery, end, startSince, endUntil):
+    """
+    Id of a tweet created within 5 s of end, found by bisecting ids between
+    the last tweets before startSince and endUntil, one search per probe.
+    """
     end_tweet = api.search(q=searchQuery, count=1, until=endUntil)[0]
     start_tweet = api.search(q=searchQuery, count=1, until=startSince)[0]
-    tweetCount = 0
-
-    # Identify ending id of tweets within timeframe using a binary search
-    # This unfortunately is not available directly through API
     while end_tweet.created_at - end > datetime.timedelta(0, 5, 0):
         mid_id = int((end_tweet.id + start_tweet.id) / 2)
         # Grab 10 tweets just to make sure they are not all zeros
@@ -56,98 +756,571 @@ def tweet_to_db(searchQuery, start, end, tweetsPerQry=100, maxTweets=100000000):
             start_tweet = mid_tweet
         else:
             end_tweet = mid_tweet
+    return end_tweet.id
 
-    max_id = end_tweet.id
+def end_max_id(api, searchQuery, end, startSince, endUntil):
+    """
+    Exclusive upper id bound of the tweets created at or before end (whole seconds),
+    to page backward from with max_id = end_max_id - 1.
+    Tweet ids are snowflakes, so the bound is computed from end directly
+    (snowflake_id), and a single search verifies it: the newest tweet below the
+    bound must not be newer than end. If it is (the ids are not snowflakes),
+    the bound falls back to bisecting ids with one search per probe.
+    """
+    max_id = snowflake_id(end + datetime.timedelta(seconds=1))
+    probe = api.search(q=searchQuery, count=1, lang='en', max_id=str(max_id - 1),
+                       since=startSince, until=endUntil)
+    if not probe or probe[0].created_at <= end:
+        return max_id
+    print("Tweet ids are not snowflakes; searching for the end id.")
+    return _bisect_end_id(api, searchQuery, end, startSince, endUntil)
 
-    # Create db to store results
-    with open('/home/ubuntu/rds_keys.txt') as rds_keys:
-        keys = rds_keys.readlines()
-    host, dbname, rds_user, rds_pw = [x.strip() for x in keys]
+def tweet_to_db(searchQuery, start, end, tweetsPerQry=100, maxTweets=100000000,
+                con=None, bulk=True, commit_every=None, tag=False, api=None):
+    """
+    This function pulls tweets with hashtag searchQuery from a specified time period.
+    tweetsPerQry = 100 is the maximal number of tweets allowed by Twitter per query.
+    maxTweets is some arbitrary big number.
+    Tweets are inserted into an SQL database with one table 'tweets',
+    which has the following 4 columns:
+    id - unique identifier
+    tweet_id - BIGINT, unique tweet id
+    datetime - TIMESTAMP, time the tweet was created
+    content - TEXT, tweet content
 
-    con = psycopg2.connect(host = host, dbname = dbname, user = rds_user, password = rds_pw, port = '5432')
-    cur = con.cursor()
+    con - database connection; defaults to one borrowed from the shared pool of
+        RDS connections. A sqlite3 connection can be passed instead as a local stand-in.
+    bulk - if True, each search page is buffered and written with one multi-row insert;
+        if False, tweets are inserted one by one.
+    commit_every - commit once at least this many rows are buffered.
+        None commits once per search page.
+    tag - if True, the tweets of each page are also cleaned, tokenized and POS tagged
+        (one batch per page), and the tagged tokens stored in table 'tagged_texts'
+        (see TaggedTextStore), so analyses of this window do not redo it.
+    api - where tweets are searched; defaults to the Twitter search API (twitter_api()).
+        Anything with the search method of tweepy.API works, such as a ReplayAPI
+        for offline load tests. Calls are scheduled by a RateLimitedAPI around it
+        (pass one in to share its quota between jobs).
 
-    create_table = """
-    CREATE TABLE IF NOT EXISTS tweets (id SERIAL PRIMARY KEY, tweet_id BIGINT, hashtag TEXT, 
-    datetime TEXT, content TEXT);
+    Time ranges already ingested by earlier calls are recorded in table 'tweet_coverage'
+    (see record_coverage); only the gaps of [start, end] are searched for. The last
+    search_index_lag before now is never recorded, so recent tweets are fetched again.
+    The count rollups in table 'tweet_counts' are updated for each gap (see update_rollups).
+
+    Returns a dict with the number of rows sent to the db, elapsed seconds and rows/sec,
+    the seconds spent tagging, the number of gaps searched, whether all of [start, end]
+    is now recorded as covered (covered; False if a search failed, maxTweets was
+    reached, or the window reaches into the last search_index_lag), and the API calls,
+    errors and seconds lost to throttling and backoff (api_* keys).
     """
-    cur.execute(create_table)
-    con.commit()
+    if con is None:
+        with pooled_connection() as con:
+            return tweet_to_db(searchQuery, start, end, tweetsPerQry, maxTweets, con=con,
+                               bulk=bulk, commit_every=commit_every, tag=tag, api=api)
+    if api is None:
+        api = twitter_api()
+    if not isinstance(api, RateLimitedAPI):
+        api = RateLimitedAPI(api)
+    api_before = api.metrics(thread=True)
 
-    cur.execute("SELECT tweet_id FROM tweets WHERE hashtag = %s", [searchQuery])
-    if not cur.rowcount:
-        unique_ids = set()
-    else:
-        unique_ids = set([x[0] for x in cur.fetchall()])
+    # Create db to store results
+    create_tweets_table(con)
+    create_coverage_table(con)
+    create_rollup_table(con)
+    tag_store = TaggedTextStore(con) if tag else None
 
-    insert_tweet = """
-    INSERT INTO tweets(tweet_id, hashtag, datetime, content) VALUES (%s, %s, %s, %s)
-    """
+    # Only the parts of [start, end] not fully ingested by earlier runs are fetched
+    gaps = coverage_gaps(con, searchQuery, start, end)
+    print("%s of %s to %s not ingested yet: %s gap(s)" % (searchQuery, start, end, len(gaps)))
 
-    while tweetCount < maxTweets:
-        try:
-            new_tweets = api.search(q=searchQuery, count=tweetsPerQry, lang='en',
-                                    max_id=str(max_id - 1), since=startSince,
-                                    until=endUntil)
+    tweetCount = 0
+    buffered_rows = []
+    rowsWritten = 0
+    db_time = 0
+    tag_time = 0
+    start_clock = time.time()
+    # Whether every gap gets recorded as covered, up to its end
+    covered = True
+    for gap_start, gap_end in gaps:
+        if tweetCount >= maxTweets:
+            covered = False
+            break
+        startSince = gap_start.strftime("%Y-%m-%d")
+        endUntil = (gap_end + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
 
-            if not new_tweets:
-                print("No more tweets found")
-                break
-            if new_tweets[-1].created_at < start:
-                print("Exhausted time interval.")
-                break
-            for tweet in new_tweets:
-                if tweet.id not in unique_ids:
-                    unique_ids.add(tweet.id)
-                    tweet_datetime = tweet.created_at
-                    tweet_datetime_str = tweet_datetime.strftime('%Y-%m-%d %H:%M:%S')
-                    tweet_list_insert = [tweet.id, searchQuery, tweet_datetime_str,
-                                         unicode(tweet.text).encode('ascii', 'replace')]
-                    cur.execute(insert_tweet, tweet_list_insert)
-                con.commit()
-            tweetCount += len(new_tweets)
-            max_id = new_tweets[-1].id
+        # Tweets of the gap posted since covered_end may not be searchable yet
+        covered_end = min(gap_end, datetime.datetime.utcnow().replace(microsecond=0) - search_index_lag)
+        # Paging starts below upper_id, right after the newest tweet of the gap
+        try:
+            upper_id = end_max_id(api, searchQuery, gap_end, startSince, endUntil)
         except tweepy.TweepError as e:
-            time.sleep(180)
+            # Retries are used up; the gap stays uncovered, so the next call resumes it
+            print("Search failed, leaving the gap for later: %s" % e)
+            covered = False
             continue
-    print("Total number of tweets: %s", tweetCount)
+        max_id = upper_id
+        min_id = None
+        gap_rows = rowsWritten
+        complete = False
+        while tweetCount < maxTweets:
+            try:
+                new_tweets = api.search(q=searchQuery, count=tweetsPerQry, lang='en',
+                                        max_id=str(max_id - 1), since=startSince,
+                                        until=endUntil)
+
+                if not new_tweets:
+                    print("No more tweets found")
+                    complete = True
+                    break
+                # The page that crosses gap_start still holds tweets of the gap
+                in_gap = [tweet for tweet in new_tweets if tweet.created_at >= gap_start]
+                # Tweets stored by earlier runs are skipped by the unique index
+                page_rows = [[tweet.id, searchQuery, _db_time(con, tweet.created_at),
+                              unicode(tweet.text).encode('ascii', 'replace')] for tweet in in_gap]
+                if tag and page_rows:
+                    # Same cleaning as the analysis applies when loading, so the texts match
+                    tag_start = time.time()
+                    with _tag_lock:
+                        textrank.getPipeline().tagTexts([clean_tweet(row[3], searchQuery) for row in page_rows],
+                                                        tagStore=tag_store)
+                    tag_time += time.time() - tag_start
+                buffered_rows.extend(page_rows)
+                if buffered_rows and (commit_every is None or len(buffered_rows) >= commit_every):
+                    db_start = time.time()
+                    insert_tweets(con, buffered_rows, bulk=bulk)
+                    con.commit()
+                    db_time += time.time() - db_start
+                    rowsWritten += len(buffered_rows)
+                    buffered_rows = []
+                if in_gap:
+                    min_id = in_gap[-1].id
+                tweetCount += len(new_tweets)
+                max_id = new_tweets[-1].id
+                if len(in_gap) < len(new_tweets):
+                    print("Exhausted time interval.")
+                    complete = True
+                    break
+            except tweepy.TweepError as e:
+                # Retries are used up; the gap stays uncovered, so the next call resumes it
+                print("Search failed, leaving the rest of the gap for later: %s" % e)
+                break
+
+        # Flush whatever is left over from the last pages, before the gap is
+        # recorded as covered
+        if buffered_rows:
+            db_start = time.time()
+            insert_tweets(con, buffered_rows, bulk=bulk)
+            con.commit()
+            db_time += time.time() - db_start
+            rowsWritten += len(buffered_rows)
+            buffered_rows = []
+        db_start = time.time()
+        update_rollups(con, searchQuery, gap_start, gap_end)
+        if not complete or covered_end < gap_end:
+            covered = False
+        if complete and covered_end > gap_start:
+            if covered_end < gap_end:
+                upper_id = min(upper_id, snowflake_id(covered_end + datetime.timedelta(seconds=1)))
+                if min_id is not None and min_id >= upper_id:
+                    min_id = None
+            record_coverage(con, searchQuery, gap_start, covered_end, min_id, upper_id - 1)
+        con.commit()
+        db_time += time.time() - db_start
+        if rowsWritten > gap_rows:
+            # Windows of this hashtag loaded before must not keep serving the old tweets
+            _window_store.invalidate(searchQuery, gap_start, gap_end)
+
+    elapsed = time.time() - start_clock
+    stats = {'rows': rowsWritten, 'seconds': elapsed,
+             'rows_per_sec': rowsWritten / elapsed if elapsed else 0,
+             'db_rows_per_sec': rowsWritten / db_time if db_time else 0,
+             'tag_seconds': tag_time, 'gaps': len(gaps), 'covered': covered}
+    # API calls, errors and seconds lost to throttling and backoff during this job
+    for key, value in api.metrics(thread=True).items():
+        stats['api_' + key] = value - api_before[key]
+    print("Total number of tweets: %s, inserted %s in %.1f s (%.0f rows/sec, %.0f rows/sec in db)"
+          % (tweetCount, rowsWritten, elapsed, stats['rows_per_sec'], stats['db_rows_per_sec']))
+    print("%s API calls, %s errors, %.1f s throttled, %.1f s in backoff"
+          % (stats['api_calls'], stats['api_errors'], stats['api_throttled_seconds'],
+             stats['api_backoff_seconds']))
+    return stats
 
-def tweets_db_to_pd(searchQuery, start, end):
+def ingest_concurrently(jobs, workers=4, max_in_flight=2, api=None, connect=None, **kwargs):
+    """
+    Crawl several (searchQuery, start, end) jobs - hashtags or time windows - at once,
+    with tweet_to_db in a pool of worker threads, as the work is I/O bound.
+    All jobs share one RateLimitedAPI, so they share its quota and have at most
+    max_in_flight search calls in flight across all of them.
+    Each job gets a db connection of its own: from the shared pool by default,
+    or opened by connect() and closed afterwards (e.g. sqlite3 for local runs).
+    Other kwargs are passed to tweet_to_db.
+
+    Returns a dict with tweet_to_db's stats of each job (in job order), the stats
+    per hashtag (rows, seconds, rows/sec over its jobs), and the overall rows,
+    wall-clock seconds and rows/sec.
+    """
+    if api is None:
+        api = twitter_api()
+    if not isinstance(api, RateLimitedAPI):
+        api = RateLimitedAPI(api, max_in_flight=max_in_flight)
+
+    def run_job(job):
+        searchQuery, start, end = job
+        if connect is None:
+            return tweet_to_db(searchQuery, start, end, api=api, **kwargs)
+        con = connect()
+        try:
+            return tweet_to_db(searchQuery, start, end, con=con, api=api, **kwargs)
+        finally:
+            con.close()
+
+    def create_tables(con):
+        create_tweets_table(con)
+        create_coverage_table(con)
+        create_rollup_table(con)
+        if kwargs.get('tag'):
+            create_tagged_texts_table(con)
+
+    # Create and migrate the tables once up front, rather than in every job at once
+    if connect is None:
+        with pooled_connection() as con:
+            create_tables(con)
+    else:
+        con = connect()
+        try:
+            create_tables(con)
+        finally:
+            con.close()
+
+    start_clock = time.time()
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        job_stats = pool.map(run_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start_clock
+
+    hashtags = collections.OrderedDict()
+    for (searchQuery, start, end), stats in zip(jobs, job_stats):
+        totals = hashtags.setdefault(searchQuery, {'rows': 0, 'seconds': 0})
+        totals['rows'] += stats['rows']
+        totals['seconds'] += stats['seconds']
+    for searchQuery, totals in hashtags.items():
+        totals['rows_per_sec'] = totals['rows'] / totals['seconds'] if totals['seconds'] else 0
+        print("%s: %s rows in %.1f s (%.0f rows/sec)"
+              % (searchQuery, totals['rows'], totals['seconds'], totals['rows_per_sec']))
+    rows = sum(stats['rows'] for stats in job_stats)
+    print("%s jobs: %s rows in %.1f s (%.0f rows/sec)" % (len(jobs), rows, elapsed,
+                                                       rows / elapsed if elapsed else 0))
+    return {'jobs': job_stats, 'hashtags': hashtags, 'rows': rows, 'seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed else 0}
+
+select_tweets = """
+SELECT id, tweet_id, datetime, content FROM tweets
+WHERE hashtag = %s AND datetime BETWEEN %s AND %s ORDER BY datetime
+"""
+
+def tweets_db_to_pd(searchQuery, start, end, con=None, clean=False):
     """
     Query SQL databased and save result into a pd dataframe.
     start and end are needed because user may search same tag w/ different
     time frame.
+    Only rows with start <= datetime <= end are read (filtered in SQL on the
+    (hashtag, datetime) index), in time order, with datetime as datetime64.
+    With clean=True, content is passed through clean_tweet once as it is loaded.
     """
-    with open('/home/ubuntu/rds_keys.txt') as rds_keys:
-        keys = rds_keys.readlines()
-    host, dbname, rds_user, rds_pw = [x.strip() for x in keys]
-
-    con = psycopg2.connect(host = host, dbname = dbname,user = rds_user, password = rds_pw, port = '5432')
+    if con is None:
+        with pooled_connection() as con:
+            return tweets_db_to_pd(searchQuery, start, end, con=con, clean=clean)
 
-    tweets_pd = pd.read_sql_query("SELECT id, tweet_id, datetime, content FROM tweets WHERE hashtag = %s", con, params = [searchQuery])
-    tweets_pd['datetime'] = tweets_pd['datetime'].apply(lambda y: datetime.datetime.strptime(y, '%Y-%m-%d %H:%M:%S'))
-    tweets_pd_rows = [start <= tweets_pd['datetime'][i] <= end for i in range(len(tweets_pd))]
-    tweets_pd = tweets_pd.loc[tweets_pd_rows, :]
+    tweets_pd = pd.read_sql_query(_sql(con, select_tweets), con,
+                                  params = [searchQuery, _db_time(con, start), _db_time(con, end)],
+                                  parse_dates = ['datetime'])
+    if clean:
+        tweets_pd['content'] = clean_tweets(tweets_pd['content'], searchQuery)
     return tweets_pd
 
+def iter_tweets_db(searchQuery, start, end, chunksize=10000, con=None, clean=False):
+    """
+    Same query as tweets_db_to_pd, but yields time-ordered pd dataframes of
+    at most chunksize rows instead of one frame for the whole window.
+    With clean=True, content is passed through clean_tweet once as it is loaded.
+    On Postgres rows are read through a server-side (named) cursor, so only
+    one chunk is held in memory at a time.
+    """
+    if con is None:
+        with pooled_connection() as con:
+            for tweets_pd in iter_tweets_db(searchQuery, start, end, chunksize, con=con, clean=clean):
+                yield tweets_pd
+        return
+
+    if _is_sqlite(con):
+        cur = con.cursor()
+    else:
+        cur = con.cursor(name='iter_tweets_db')
+        cur.itersize = chunksize
+    try:
+        cur.execute(_sql(con, select_tweets), [searchQuery, _db_time(con, start), _db_time(con, end)])
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows:
+                break
+            tweets_pd = pd.DataFrame(rows, columns=['id', 'tweet_id', 'datetime', 'content'])
+            tweets_pd['datetime'] = pd.to_datetime(tweets_pd['datetime'])
+            if clean:
+                tweets_pd['content'] = clean_tweets(tweets_pd['content'], searchQuery)
+            yield tweets_pd
+    finally:
+        cur.close()
+
+class TweetBuckets(object):
+    """
+    Tweets grouped by time intervals, stored column-wise (CSR style):
+    content - 1-D object array of all tweets, ordered by interval
+    offsets - the tweets of interval k are content[offsets[k]:offsets[k + 1]]
+    counts - number of tweets per interval, np.diff(offsets)
+    start_time, interval - interval k starts at start_time + k * interval
+
+    tweet_buckets['count'] and tweet_buckets['time'] return pd Series, as the
+    columns of the dataframe group_tweets used to return.
+    """
+    def __init__(self, content, offsets, start_time, interval):
+        self.content = content
+        self.offsets = offsets
+        self.counts = np.diff(offsets)
+        self.start_time = start_time
+        self.interval = interval
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, column):
+        if column == 'count':
+            return pd.Series(self.counts)
+        if column == 'time':
+            return pd.Series(self.times)
+        raise KeyError(column)
+
+    @property
+    def times(self):
+        step = np.timedelta64(pd.Timedelta(self.interval).value, 'ns')
+        return pd.Timestamp(self.start_time).to_datetime64() + np.arange(len(self)) * step
+
+    def tweets(self, first, last=None):
+        """
+        Tweets of intervals first to last (inclusive), as a view into content.
+        """
+        if last is None:
+            last = first
+        return self.content[self.offsets[first]:self.offsets[last + 1]]
+
+    @property
+    def end_time(self):
+        """
+        End of the last interval (exclusive).
+        """
+        return pd.Timestamp(self.start_time) + len(self) * pd.Timedelta(self.interval)
+
+    def slice(self, first, last):
+        """
+        TweetBuckets of intervals first to last (inclusive), sharing content.
+        """
+        offsets = self.offsets[first:last + 2]
+        return TweetBuckets(self.content[offsets[0]:offsets[-1]], offsets - offsets[0],
+                            pd.Timestamp(self.start_time) + first * pd.Timedelta(self.interval),
+                            self.interval)
+
+def concat_buckets(first, second):
+    """
+    TweetBuckets of two runs of intervals, second starting where first ends.
+    """
+    return TweetBuckets(np.concatenate([first.content, second.content]),
+                        np.r_[first.offsets, second.offsets[1:] + first.offsets[-1]],
+                        first.start_time, first.interval)
+
 def group_tweets(tweet_pd, interval = datetime.timedelta(0, 1, 0)):
     """
-    Group tweets by time intervals.
-    Returns a pd dataframe with three columns:
-    time, number of tweets, all tweets within interval in a list
+    Group tweets by time intervals, starting from the earliest tweet.
+    Returns a TweetBuckets with the number of tweets and the tweets
+    within each interval.
     """
     start_time = min(tweet_pd['datetime'])
-    tweet_pd['timegroup'] = np.floor((tweet_pd['datetime'] - start_time) / interval).astype(int)
-    tweet_grouped = tweet_pd.groupby(['timegroup'])
-    tweet_count = tweet_grouped['datetime'].aggregate(['count'])
-    tweet_count.columns = ['count']
-    tweet_count = tweet_count.reindex(range(min(tweet_count.index.values), max(tweet_count.index.values) + 1),
-                                      fill_value=0)
-    tweet_count['time'] = tweet_count.index.values * interval + start_time
-    tweet_count['agg_tweets'] = tweet_grouped['content'].aggregate(lambda x: list(x))
-    for row in tweet_count.loc[tweet_count.agg_tweets.isnull(), 'agg_tweets'].index:
-        tweet_count.at[row, 'agg_tweets'] = []
-    return tweet_count
+    timegroup = np.floor((tweet_pd['datetime'] - start_time) / interval).astype(int).values
+    # Stable sort keeps tweets within an interval in their original order
+    order = np.argsort(timegroup, kind='mergesort')
+    offsets = np.r_[0, np.cumsum(np.bincount(timegroup))]
+    content = tweet_pd['content'].values.astype(object)[order]
+    return TweetBuckets(content, offsets, start_time, interval)
+
+def group_tweets_chunked(tweet_chunks, interval = datetime.timedelta(0, 1, 0),
+                         start_time=None, end_time=None):
+    """
+    Incremental version of group_tweets for the time-ordered chunks yielded by
+    iter_tweets_db. Only the bucket counts and the tweet text of each chunk
+    are kept.
+    Returns the same TweetBuckets as group_tweets. Intervals start at start_time
+    instead of the earliest tweet if given, and run up to end_time (exclusive)
+    if given, so that windows line up with each other.
+    """
+    counts = np.zeros(0, dtype=int)
+    content = []
+    for tweet_pd in tweet_chunks:
+        if not len(tweet_pd):
+            continue
+        if start_time is None:
+            start_time = tweet_pd['datetime'].iloc[0]
+        timegroup = np.floor((tweet_pd['datetime'] - start_time) / interval).astype(int).values
+        chunk_counts = np.bincount(timegroup)
+        if len(chunk_counts) > len(counts):
+            counts = np.r_[counts, np.zeros(len(chunk_counts) - len(counts), dtype=int)]
+        counts[:len(chunk_counts)] += chunk_counts
+        content.append(tweet_pd['content'].values.astype(object))
+
+    if end_time is not None:
+        n_intervals = int(np.ceil((pd.Timestamp(end_time) - pd.Timestamp(start_time)) / pd.Timedelta(interval)))
+        counts = np.r_[counts, np.zeros(max(n_intervals - len(counts), 0), dtype=int)]
+    offsets = np.r_[0, np.cumsum(counts)].astype(int)
+    if content:
+        content = np.concatenate(content)
+    else:
+        content = np.empty(0, dtype=object)
+    return TweetBuckets(content, offsets, start_time, interval)
+
+class WindowStore(object):
+    """
+    TweetBuckets already loaded for each hashtag, kept as one contiguous run of
+    intervals per (hashtag, interval, clean), for the most recently used
+    max_runs of those that fit in max_bytes (counting the tweet strings; a
+    larger run is not kept). A window that overlaps or touches the stored run
+    only loads the intervals it adds (before and after the run) from the db,
+    and is returned as a slice of the extended run; other windows replace the
+    run.
+    Runs are trimmed to max_span (or the window, if longer), dropping the
+    oldest intervals first.
+    tweet_to_db calls invalidate() for the time ranges it writes tweets to, so
+    those intervals are loaded again; tweets written by other processes are
+    not seen until the run is replaced.
+    """
+    def __init__(self, max_runs=32, max_span=datetime.timedelta(hours=6), max_bytes=256 * 2 ** 20):
+        self.max_runs = max_runs
+        self.max_span = pd.Timedelta(max_span)
+        self.max_bytes = max_bytes
+        self.runs = collections.OrderedDict()
+        # Size in bytes of each stored run, and their total
+        self.sizes = {}
+        self.bytes = 0
+        # Bumped by invalidate, so runs loaded meanwhile are not stored
+        self.versions = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.loaded_seconds = 0
+
+    @staticmethod
+    def _keep(run, first, last):
+        # Copy, so the intervals dropped are freed
+        part = run.slice(first, last)
+        return TweetBuckets(part.content.copy(), part.offsets, part.start_time, part.interval)
+
+    @staticmethod
+    def size(run):
+        return run.content.nbytes + run.offsets.nbytes + sum(map(sys.getsizeof, run.content))
+
+    def _store(self, key, run, size):
+        # Called with the lock held
+        self._drop(key)
+        if size > self.max_bytes:
+            return
+        self.runs[key] = run
+        self.sizes[key] = size
+        self.bytes += size
+        while len(self.runs) > self.max_runs or self.bytes > self.max_bytes:
+            self._drop(next(iter(self.runs)))
+
+    def _drop(self, key):
+        # Called with the lock held
+        if self.runs.pop(key, None) is not None:
+            self.bytes -= self.sizes.pop(key)
+
+    def invalidate(self, hashtag, start, end):
+        """
+        Drop the stored intervals of hashtag that overlap [start, end]. Runs keep
+        the intervals before those, or else the ones after.
+        """
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        with self.lock:
+            self.versions[hashtag] += 1
+            for key, run in list(self.runs.items()):
+                if key[0] != hashtag:
+                    continue
+                step = key[1]
+                first = int((start - pd.Timestamp(run.start_time)) // step)
+                last = int((end - pd.Timestamp(run.start_time)) // step)
+                if last < 0 or first >= len(run):
+                    continue
+                if first > 0:
+                    run = self._keep(run, 0, first - 1)
+                elif last < len(run) - 1:
+                    run = self._keep(run, last + 1, len(run) - 1)
+                else:
+                    self._drop(key)
+                    continue
+                # Keeps the run's place in the LRU order
+                size = self.size(run)
+                self.bytes += size - self.sizes[key]
+                self.sizes[key] = size
+                self.runs[key] = run
+
+    def _load(self, hashtag, start, stop, interval, con, clean):
+        # BETWEEN is inclusive; timestamps have whole seconds at most
+        tweet_chunks = iter_tweets_db(hashtag, start.to_pydatetime(),
+                                      (stop - pd.Timedelta(microseconds=1)).to_pydatetime(),
+                                      con=con, clean=clean)
+        self.loaded_seconds += (stop - start).total_seconds()
+        return group_tweets_chunked(tweet_chunks, interval, start, stop)
+
+    def window(self, hashtag, start, end, interval=datetime.timedelta(0, 1, 0), con=None, clean=True):
+        """
+        TweetBuckets of the tweets of hashtag with start <= datetime <= end, in
+        intervals starting at start.
+        """
+        start = pd.Timestamp(start)
+        step = pd.Timedelta(interval)
+        stop = start + (int((pd.Timestamp(end) - start) / step) + 1) * step
+        key = (hashtag, step, clean)
+        with self.lock:
+            run = stored = self.runs.get(key)
+            stored_size = self.sizes.get(key)
+            version = self.versions[hashtag]
+        if run is None or (start - pd.Timestamp(run.start_time)) % step or \
+                stop < run.start_time or start > run.end_time:
+            run = self._load(hashtag, start, stop, interval, con, clean)
+        else:
+            if start < run.start_time:
+                run = concat_buckets(self._load(hashtag, start, pd.Timestamp(run.start_time), interval, con, clean), run)
+            if stop > run.end_time:
+                run = concat_buckets(run, self._load(hashtag, run.end_time, stop, interval, con, clean))
+        first = int((start - pd.Timestamp(run.start_time)) / step)
+        n = int((stop - start) / step)
+        excess = len(run) - max(n, int(self.max_span / step))
+        if excess > 0:
+            drop_before = min(first, excess)
+            run = self._keep(run, drop_before, len(run) - 1 - (excess - drop_before))
+            first -= drop_before
+        # Measure the run again only if it changed
+        size = stored_size if run is stored else self.size(run)
+        with self.lock:
+            if self.versions[hashtag] == version:
+                self._store(key, run, size)
+        return run.slice(first, first + n - 1)
+
+_window_store = WindowStore()
+
+def window_buckets(hashtag, start, end, interval=datetime.timedelta(0, 1, 0), con=None, clean=True):
+    """
+    TweetBuckets of the (cleaned) tweets of hashtag between start and end,
+    reusing the intervals loaded for overlapping windows (see WindowStore).
+    """
+    return _window_store.window(hashtag, start, end, interval, con, clean)
 
 def peakdet(v, delta):
     """
@@ -181,96 +1354,393 @@ def peakdet(v, delta):
     x = np.arange(len(v))
 
     v = np.asarray(v)
+    # Python scalars compare much faster than numpy ones, and give the same
+    # results for integers and doubles; other dtypes keep numpy's arithmetic
+    if v.dtype.kind in 'biu' or v.dtype == np.float64:
+        values = v.tolist()
+    else:
+        values = v
 
-    mn, mx = np.Inf, -np.Inf
-    mnpos, mxpos = np.NaN, np.NaN
-
+    # Alternate between looking for a maximum and a minimum, as in the original
+    # loop. Each phase is scanned by _peakdet_phase with cumulative max/min over
+    # blocks of v, so Python only loops once per block instead of once per element.
     lookformax = True
+    ext, extpos, scan = None, None, 0
+    while True:
+        ext, extpos, end = _peakdet_phase(v, values, scan, ext, extpos, delta, lookformax)
+        if end is None:
+            break
+        if lookformax:
+            maxtab.append((x[extpos], ext))
+        else:
+            mintab.append((x[extpos], ext))
+        lookformax = not lookformax
+        # The point that ends a phase starts the next one
+        ext, extpos, scan = values[end], end, end + 1
 
-    for i in np.arange(len(v)):
-        this = v[i]
-        if this > mx:
-            mx = this
-            mxpos = x[i]
-        if this < mn:
-            mn = this
-            mnpos = x[i]
+    return np.array(maxtab), np.array(mintab)
 
+def _peakdet_phase(v, values, scan, ext, extpos, delta, lookformax, block=64, short=64):
+    """
+    Helper for peakdet.
+    Starting from index scan, with running extreme ext found at extpos (None if
+    nothing has been seen yet), follow the running max (lookformax) or min of v
+    until a point lies more than delta below the max (above the min).
+    Returns (extreme, position of extreme, index of that point), the last
+    one being None if v ends first.
+    Ties keep the earliest position, NaNs are skipped, like the original loop.
+    The first short points are compared one at a time, from values (v as a
+    list, or v itself), since noisy and quiet series switch phase every few
+    dozen points at most; after that blocks start small and double.
+    """
+    if extpos is None:
+        best = -np.inf if lookformax else np.inf
+    else:
+        best = ext
+    for i in range(scan, min(scan + short, len(v))):
+        this = values[i]
         if lookformax:
-            if this < mx - delta:
-                maxtab.append((mxpos, mx))
-                mn = this
-                mnpos = x[i]
-                lookformax = False
+            if this > best:
+                best, extpos = this, i
+            if this < best - delta:
+                return best, extpos, i
         else:
-            if this > mn + delta:
-                mintab.append((mnpos, mn))
-                mx = this
-                mxpos = x[i]
-                lookformax = True
+            if this < best:
+                best, extpos = this, i
+            if this > best + delta:
+                return best, extpos, i
+    if extpos is not None:
+        ext = best
 
-    return np.array(maxtab), np.array(mintab)
+    if lookformax:
+        accumulate, combine = np.fmax.accumulate, np.fmax
+    else:
+        accumulate, combine = np.fmin.accumulate, np.fmin
+    a = scan + short
+    while a < len(v):
+        seg = v[a:a + block]
+        run = accumulate(seg)
+        if extpos is not None:
+            run = combine(run, ext)
+        if lookformax:
+            hit = np.flatnonzero(seg < run - delta)
+        else:
+            hit = np.flatnonzero(seg > run + delta)
+        h = hit[0] if hit.size else len(seg) - 1
+        best = run[h]
+        if extpos is None or (best > ext if lookformax else best < ext):
+            where = np.flatnonzero(seg[:h + 1] == best)
+            if where.size:
+                ext, extpos = best, a + where[0]
+        if hit.size:
+            return ext, extpos, a + h
+        a += len(seg)
+        block *= 2
+    return ext, extpos, None
+
+def peak_bounds(counts):
+    """
+    For each index k of counts, returns the first index of the non-decreasing
+    run that ends at k and the last index of the non-increasing run that starts
+    at k. A peak at k spans left[k]:right[k] + 1.
+    """
+    counts = np.asarray(counts)
+    idx = np.arange(len(counts))
+    # k starts a new rising run where counts drops into it from the left
+    run_start = np.r_[True, counts[1:] < counts[:-1]]
+    left = np.maximum.accumulate(np.where(run_start, idx, 0))
+    # k ends its falling run where counts rises right after it
+    run_end = np.r_[counts[:-1] < counts[1:], True]
+    right = np.minimum.accumulate(np.where(run_end, idx, len(counts) - 1)[::-1])[::-1]
+    return left, right
 
 def get_peaks(tweet_count, delta=0.25):
     """
+    tweet_count - TweetBuckets from group_tweets
     Returns a list of four sublists:
     peak_vals - number of tweets at peaks
     peak_time - timestamp of peaks
     peak_groups - indices of time intervals that belong to each peaks
-    peak_tweets - list of lists, each sublist being a list of strings for tweets
-        within one peak
-    """
-    sig = peakdet(tweet_count['count'], max(tweet_count['count']) * delta)
-    peaks = sig[0]
-    loc = [x[0] for x in peaks]
-    peak_vals = [x[1] for x in peaks]
-    peak_time = tweet_count.ix[loc, 'time'].values
+    peak_tweets - list of arrays, each being the strings for tweets
+        within one peak, in time order
+    """
+    counts = tweet_count.counts
+    sig = peakdet(counts, max(counts) * delta)
+    peaks = sig[0].reshape(-1, 2)
+    loc = peaks[:, 0].astype(int)
+    peak_vals = list(peaks[:, 1])
+    peak_time = tweet_count.times[loc]
     # Define each peak as non-increasing towards both sides
     peak_groups, peak_tweets = [], []
-    for single_loc in loc:
-        single_group = [single_loc]
-        tweet_group = tweet_count.ix[single_loc, 'agg_tweets']
-        i, j = single_loc - 1, single_loc + 1
-        while tweet_count.ix[i, 'count'] <= tweet_count.ix[i + 1, 'count'] and i >= 0:
-            single_group.extend([i])
-            tweet_group += tweet_count.ix[i, 'agg_tweets']
-            i -= 1
-        while tweet_count.ix[j, 'count'] <= tweet_count.ix[j - 1, 'count'] \
-                and j < len(tweet_count.index):
-            single_group.extend([j])
-            tweet_group += tweet_count.ix[j, 'agg_tweets']
-            j += 1
-        peak_groups.append(single_group)
-        peak_tweets.append(tweet_group)
+    if len(loc):
+        left, right = peak_bounds(counts)
+        for single_loc in loc:
+            first, last = left[single_loc], right[single_loc]
+            peak_groups.append(np.arange(first, last + 1))
+            peak_tweets.append(tweet_count.tweets(first, last))
     return [peak_vals, peak_time, peak_groups, peak_tweets]
 
+PeakEvent = collections.namedtuple('PeakEvent', ['kind', 'position', 'time', 'count', 'detected_at'])
+
+class StreamingPeakDetector(object):
+    """
+    Online version of peakdet, for live events: consumes bucket counts one at a
+    time (update) or in micro-batches (feed) and keeps O(1) state.
+    Returns PeakEvents as soon as they are known:
+    'start' - counts rose more than delta above the preceding minimum, at
+        position/time of that minimum: a peak is under way
+    'peak' - counts fell more than delta below the maximum since then, at
+        position/time of that maximum (count): the peak is confirmed
+    detected_at is the position of the bucket that triggered the event.
+    With an absolute delta the confirmed peaks are those of peakdet(counts, delta).
+    Otherwise delta is delta_fraction of the largest count seen so far, the
+    online counterpart of get_peaks' max(counts) * delta.
+    """
+    def __init__(self, delta=None, delta_fraction=0.25):
+        self.delta = delta
+        self.delta_fraction = delta_fraction
+        self.position = -1
+        self.mn, self.mx = np.inf, -np.inf
+        self.mnpos, self.mxpos = None, None
+        self.mntime, self.mxtime = None, None
+        self.peak_max = -np.inf
+        self.lookformax = True
+        self.started = False
+
+    def update(self, count, bucket_time=None):
+        """
+        Consume the count of the next bucket (starting at bucket_time, if given).
+        Returns the list of PeakEvents it triggers.
+        """
+        self.position += 1
+        events = []
+        if count > self.peak_max:
+            self.peak_max = count
+        delta = self.delta if self.delta is not None else self.delta_fraction * self.peak_max
+        if count > self.mx:
+            self.mx, self.mxpos, self.mxtime = count, self.position, bucket_time
+        if count < self.mn:
+            self.mn, self.mnpos, self.mntime = count, self.position, bucket_time
+
+        if self.lookformax:
+            if count < self.mx - delta:
+                events.append(PeakEvent('peak', self.mxpos, self.mxtime, self.mx, self.position))
+                self.mn, self.mnpos, self.mntime = count, self.position, bucket_time
+                self.lookformax = False
+                self.started = False
+        elif count > self.mn + delta:
+            self.mx, self.mxpos, self.mxtime = count, self.position, bucket_time
+            self.lookformax = True
+        if self.lookformax and not self.started and count > self.mn + delta:
+            events.append(PeakEvent('start', self.mnpos, self.mntime, self.mn, self.position))
+            self.started = True
+        return events
+
+    def feed(self, counts, times=None):
+        """
+        update() for a micro-batch of bucket counts; returns all their events.
+        """
+        events = []
+        if times is None:
+            times = [None] * len(counts)
+        for count, t in zip(counts, times):
+            events.extend(self.update(count, t))
+        return events
+
+def stream_buckets(tweets, interval=datetime.timedelta(0, 1, 0), start_time=None):
+    """
+    Bucket counts of a time-ordered stream of tweets (anything with created_at),
+    as (bucket start, count) for each bucket once it is complete, including
+    empty buckets. Buckets start at start_time, or at the first tweet.
+    Keeps O(1) state, so it can follow a live or replayed stream.
+    """
+    bucket_start, count = start_time, 0
+    for tweet in tweets:
+        if bucket_start is None:
+            bucket_start = tweet.created_at
+        while tweet.created_at >= bucket_start + interval:
+            yield bucket_start, count
+            bucket_start, count = bucket_start + interval, 0
+        count += 1
+    if bucket_start is not None:
+        yield bucket_start, count
+
+def live_peaks(tweets, interval=datetime.timedelta(0, 1, 0), delta=None, delta_fraction=0.25,
+               start_time=None):
+    """
+    Follow a time-ordered stream of tweets (e.g. ReplayAPI.stream) and yield
+    the PeakEvents of a StreamingPeakDetector over its bucket counts, as they happen.
+    """
+    detector = StreamingPeakDetector(delta, delta_fraction)
+    for bucket_start, count in stream_buckets(tweets, interval, start_time):
+        for event in detector.update(count, bucket_start):
+            yield event
+
+def choose_resolution(start, end, max_buckets=2000):
+    """
+    Finest of rollup_resolutions that spans [start, end] in at most max_buckets
+    buckets, i.e. the coarsest one needed to stay within that budget.
+    """
+    seconds = (pd.Timestamp(end) - pd.Timestamp(start)).total_seconds()
+    for resolution in rollup_resolutions:
+        if seconds / resolution <= max_buckets:
+            return resolution
+    return rollup_resolutions[-1]
+
+def rollup_counts(hashtag, start, end, resolution=None, con=None, max_buckets=2000):
+    """
+    Tweets of hashtag per bucket of resolution seconds (choose_resolution(start, end,
+    max_buckets) by default) from the bucket of start to the bucket of end, read
+    from the rollups, including empty buckets.
+    Returns a pd dataframe with columns time and count, like tweet_count in plot_Ntweets.
+    """
+    if con is None:
+        with pooled_connection() as con:
+            return rollup_counts(hashtag, start, end, resolution, con, max_buckets)
+    if resolution is None:
+        resolution = choose_resolution(start, end, max_buckets)
+    first = _floor_time(start, resolution)
+    n_buckets = int((_floor_time(end, resolution) - first).total_seconds()) // resolution + 1
+    cur = con.cursor()
+    cur.execute(_sql(con, """
+    SELECT bucket, count FROM tweet_counts
+    WHERE hashtag = %s AND resolution = %s AND bucket >= %s AND bucket <= %s
+    """), [hashtag, resolution, _db_time(con, first), _db_time(con, end)])
+    counts = np.zeros(n_buckets, dtype=int)
+    for bucket, count in cur.fetchall():
+        counts[int((_from_db_time(con, bucket) - first).total_seconds()) // resolution] = count
+    times = pd.Timestamp(first).to_datetime64() + np.arange(n_buckets) * np.timedelta64(resolution, 's')
+    return pd.DataFrame({'time': times, 'count': counts})
+
+def scan_peaks(hashtag, start, end, delta=0.25, con=None, max_buckets=2000):
+    """
+    Peak scan of a long time range from the rollups, at the resolution picked
+    by choose_resolution, without loading any tweets.
+    Returns a list of three sublists:
+    peak_vals - number of tweets in the bucket of each peak
+    peak_time - timestamp of peaks
+    peak_spans - (first, last) time of each peak, to load its tweets only
+    """
+    resolution = choose_resolution(start, end, max_buckets)
+    timeline = rollup_counts(hashtag, start, end, resolution, con)
+    counts = timeline['count'].values
+    times = timeline['time'].values
+    if not counts.any():
+        return [[], times[:0], []]
+    peaks = peakdet(counts, max(counts) * delta)[0].reshape(-1, 2)
+    loc = peaks[:, 0].astype(int)
+    left, right = peak_bounds(counts)
+    last_second = np.timedelta64(resolution - 1, 's')
+    peak_spans = [(times[left[k]], times[right[k]] + last_second) for k in loc]
+    return [list(peaks[:, 1]), times[loc], peak_spans]
+
+_tweet_cleaners = {}
+
+def tweet_cleaner(hashtag):
+    """
+    Compiled regex matching everything clean_tweet removes: urls, @mentions,
+    the original hashtag, RT, newlines and carriage returns.
+    Compiled once per hashtag.
+    """
+    if hashtag not in _tweet_cleaners:
+        patterns = [r"http\S+", r"@\S+", "RT", "\n", "\r"]
+        if hashtag:
+            patterns.insert(2, re.escape(hashtag))
+        _tweet_cleaners[hashtag] = re.compile('|'.join(patterns))
+    return _tweet_cleaners[hashtag]
+
+def _clean_match(match):
+    # Newlines become spaces, everything else is dropped
+    if match.group(0) == '\n':
+        return ' '
+    return ''
+
 def clean_tweet(tweet_string, hashtag):
     """
-    Clean a string of tweet(s) by removing original hashtag, urls, @, RT, and newlines
+    Clean a string of tweet(s) by removing original hashtag, urls, @, RT, and newlines,
+    in a single pass of the precompiled tweet_cleaner(hashtag).
+    """
+    return tweet_cleaner(hashtag).sub(_clean_match, tweet_string)
+
+def clean_tweets(contents, hashtag):
+    """
+    clean_tweet applied to each tweet in a pd Series of tweet contents.
+    """
+    cleaner = tweet_cleaner(hashtag)
+    return contents.map(lambda x: cleaner.sub(_clean_match, x))
+
+def peak_keywords(peaks, orig_tag = '', clean=True):
+    """
+    Clean the tweets of each peak in peaks (unless clean=False, for tweets
+    already cleaned when they were loaded).
+    Returns the #1 keyword of each peak determined by TextRank.
+    Repeated tweets (retweets) are tagged once, through the tag cache of the
+    process-wide NLP pipeline, and weighted by how often they occur.
+    """
+    keywords = []
+    for peak in peaks:
+        if clean:
+            tweets = [clean_tweet(tweet, orig_tag) for tweet in peak]
+        else:
+            tweets = peak
+        peak_textrank = textrank.extractKeyphrasesTweets(tweets)
+        keywords.append(sorted(peak_textrank.items(), key = lambda x: x[1], reverse = True)[0][0])
+    return keywords
+
+def _peak_keyword_args(args):
+    peak, orig_tag, clean = args
+    return peak_keywords([peak], orig_tag, clean)[0]
+
+def _warm_nltk(tag_store=False):
+    """
+    Pool initializer: load the NLTK tokenizer and tagger models once per worker.
+    With tag_store=True the worker also opens its own TaggedTextStore connection,
+    instead of sharing the store connection inherited from the parent.
+    """
+    textrank.getPipeline().load()
+    if tag_store:
+        use_tag_store(connect_db())
+
+_textrank_pool = None
+_textrank_pool_key = None
+
+def textrank_pool(processes=None):
+    """
+    Long-lived process pool for textrank_analysis, with the NLTK models already
+    loaded in every worker. processes defaults to the number of CPUs.
+    Workers use a tag store of their own if this process uses one (use_tag_store).
+    The pool is created on first use, and recreated if processes or that changes.
     """
-    cleaned_tweet = re.sub(r"http\S+", "", tweet_string)
-    cleaned_tweet = re.sub(r"@\S+", "", cleaned_tweet)
-    cleaned_tweet = cleaned_tweet.replace(hashtag, '').replace('RT', '').replace('\n', ' ').replace('\r', '')
-    return cleaned_tweet
+    global _textrank_pool, _textrank_pool_key
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    tag_store = textrank.getPipeline().tagStore is not None
+    if _textrank_pool is None or _textrank_pool_key != (processes, tag_store):
+        if _textrank_pool is not None:
+            _textrank_pool.terminate()
+        _textrank_pool = multiprocessing.Pool(processes, initializer=_warm_nltk,
+                                              initargs=(tag_store,))
+        _textrank_pool_key = (processes, tag_store)
+    return _textrank_pool
 
-def textrank_analysis(peak_tweets, orig_tag = ''):
+def textrank_analysis(peak_tweets, orig_tag = '', processes=None, clean=True):
     """
     Takes a list of lists of tweets, with each sublist being tweets within a peak
-    Concatenate & clean tweets.
+    Concatenate & clean tweets (clean=False if they were cleaned at load time).
     Returns a list of #1 keyword for each sublist determined by TextRank.
+    Peaks are handled in parallel by textrank_pool(processes); results come back
+    in peak order. processes=1 runs everything in this process.
     """
-    textrank_kw = []
-    for peak in peak_tweets:
-        text = '.'.join(peak)
-        text = clean_tweet(text, orig_tag)
-        peak_textrank = textrank.extractKeyphrases(text)
-        textrank_keys = sorted(peak_textrank.items(), key = lambda x: x[1], reverse = True)[0][0]
-        textrank_kw.append(textrank_keys)
-    return textrank_kw
+    if processes == 1 or len(peak_tweets) < 2:
+        return peak_keywords(peak_tweets, orig_tag, clean)
+    pool = textrank_pool(processes)
+    return pool.map(_peak_keyword_args, [(peak, orig_tag, clean) for peak in peak_tweets], chunksize=1)
 
-def plot_timeline(peak_vals, tweet_kw, hashtag, start_time):
+def plot_timeline(peak_vals, tweet_kw, hashtag, start_time, plotfile=None):
     """
     Plot timeline along with keywords.
+    plotfile - path or file object the PNG is written to; defaults to
+    flaskexample/static/timeline_<hashtag>_<start_time>.png
     """
     print "plot_timeline is being called."
     sns.set_style("white")
@@ -289,12 +1759,16 @@ def plot_timeline(peak_vals, tweet_kw, hashtag, start_time):
               length_includes_head=False, head_width=8, head_length=3.8)
     plt.axis('tight')
 
-    plotfile = 'flaskexample/static/timeline_' + hashtag.strip('#') + '_' + start_time + '.png'
-    plt.savefig(plotfile)
+    if plotfile is None:
+        plotfile = 'flaskexample/static/timeline_' + hashtag.strip('#') + '_' + start_time + '.png'
+    plt.savefig(plotfile, format='png')
+    plt.close()
 
-def plot_Ntweets(tweet_count, peak_time, peak_vals, hashtag, start_time):
+def plot_Ntweets(tweet_count, peak_time, peak_vals, hashtag, start_time, plotfile=None):
     """
     Plot the number of tweets through time.
+    plotfile - path or file object the PNG is written to; defaults to
+    flaskexample/static/Ntweets_<hashtag>_<start_time>.png
     """
     sns.set_style("darkgrid")
     plt.figure()
@@ -307,5 +1781,7 @@ def plot_Ntweets(tweet_count, peak_time, peak_vals, hashtag, start_time):
     plt.arrow(x0, 0, x1 - x0, 0, shape='full', lw=2, color='black',
               length_includes_head=False, head_width=4, head_length=0.01)
     plt.scatter(peak_time, peak_vals, c = 'red')
-    plotfile = 'flaskexample/static/Ntweets_' + hashtag.strip('#') + '_' + start_time + '.png'
-    plt.savefig(plotfile)
+    if plotfile is None:
+        plotfile = 'flaskexample/static/Ntweets_' + hashtag.strip('#') + '_' + start_time + '.png'
+    plt.savefig(plotfile, format='png')
+    plt.close()
@@ -1,37 +1,124 @@
-from flask import render_template, Flask, request, copy_current_request_context
+from flask import render_template, Flask, request, copy_current_request_context, Response, jsonify, url_for, abort
 from flaskexample import app
 import datetime
 import tweet_functions as tweet
-import os.path
-import os
+from lrucache import LRUCache
+import numpy as np
+import hashlib
+import io
+import json
+import sys
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 executor = ThreadPoolExecutor(1)
 
-def run_analysis(hashtag, start_time, duration):
+# Parameters of the analysis that change its result; part of the result cache key
+analysis_params = {'interval_seconds': 1, 'delta': 0.25, 'max_plot_points': 2000}
+
+def analysis_key(hashtag, start_time, duration, params=analysis_params):
+    """
+    Content address of an analysis: SHA-1 of its canonical inputs, so that
+    e.g. durations '60' and '60.0' share one result.
+    """
+    start = datetime.datetime.strptime(start_time, '%Y-%m-%d-%H-%M')
+    inputs = [hashtag, start.isoformat(), float(duration), sorted(params.items())]
+    return hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()
+
+class ResultCache(LRUCache):
+    """
+    Thread-safe LRU cache of analysis results (peaks, keywords and rendered
+    plots), keyed by analysis_key. Holds at most max_entries results and
+    max_bytes of plots; the least recently used are evicted first.
+
+    Results of windows not fully ingested yet are put with a ttl, so they are
+    recomputed once more tweets can be fetched.
+
+    metrics() reports entries, bytes held, hits, misses, hit rate, evictions and
+    expirations; describe() lists the cached analyses, most recently used last.
+    """
+    def __init__(self, max_entries=1000, max_bytes=256 * 2 ** 20):
+        LRUCache.__init__(self, max_entries, max_bytes)
+
+    @staticmethod
+    def size(result):
+        return sys.getsizeof(result) + sum(len(png) for png in result.get('plots', {}).values())
+
+    def put(self, key, result, ttl=None):
+        LRUCache.put(self, key, result, self.size(result), ttl)
+
+    def describe(self):
+        with self.lock:
+            return [{'key': key, 'hashtag': result['hashtag'], 'start_time': result['start_time'],
+                     'duration': result['duration'], 'params': result['params'],
+                     'warning': result['warning'], 'complete': result['complete'],
+                     'bytes': size, 'expires': expires}
+                    for key, (result, size, expires) in self.entries.items()]
+
+results = ResultCache()
+# Seconds results of windows not fully ingested yet are served for
+partial_result_ttl = 60
+# Analyses submitted to the executor and not finished yet, by key
+pending = {}
+pending_lock = threading.Lock()
+
+def run_analysis(hashtag, start_time, duration, params=analysis_params):
     """
     Carry out analysis for user inputs.
-    Saves result to static.
+    Returns the result as a dict: the inputs, complete (False if the window
+    was not fully ingested: it reaches into the last few minutes, or a search
+    failed), warning (True if there were too few tweets to analyse), and
+    otherwise the peaks, their keywords and the two plots as PNG bytes.
     """
     start = datetime.datetime.strptime(start_time, '%Y-%m-%d-%H-%M')
-    duration = datetime.timedelta(minutes = float(duration))
-    end = start + duration
+    end = start + datetime.timedelta(minutes = float(duration))
+    result = {'hashtag': hashtag, 'start_time': start_time, 'duration': duration,
+              'params': params, 'warning': False}
 
-    # Feed inputs into tweet functions
-    tweet.tweet_to_db(hashtag, start, end)
-    tweet_pd = tweet.tweets_db_to_pd(hashtag, start, end)
-    tweet_count = tweet.group_tweets(tweet_pd)
+    # Feed inputs into tweet functions. Tweets are not tagged at ingest: only
+    # the peak tweets are, by textrank_analysis's worker pool, and their tags
+    # go to the tag store for later analyses of overlapping windows
+    stats = tweet.tweet_to_db(hashtag, start, end)
+    result['complete'] = stats['covered'] and \
+        end < datetime.datetime.utcnow() - tweet.search_index_lag
+    # Intervals already loaded for overlapping windows of this hashtag are reused
+    tweet_count = tweet.window_buckets(hashtag, start, end,
+                                       datetime.timedelta(seconds = params['interval_seconds']))
     # If too few tweets, return warning to uesr
     if max(tweet_count['count']) < 30 or np.mean(tweet_count['count']) < 10:
         print 'Enter warning branch'
-        warning_file = open('flaskexample/static/warning_cases.txt', 'a')
-        print >> warning_file, hashtag.strip('#') + '\t' + start_time
-        warning_file.close()
+        result['warning'] = True
+        return result
+    peak_vals, peak_time, peak_groups, peak_tweets = tweet.get_peaks(tweet_count, params['delta'])
+    # The tag store's connection is borrowed from the pool for the keyword extraction only
+    with tweet.pooled_tag_store():
+        tweet_kw = tweet.textrank_analysis(peak_tweets, orig_tag=hashtag, clean=False)
+    ntweet_png = io.BytesIO()
+    timeline_png = io.BytesIO()
+    # Long windows are plotted from the coarsest count rollup that still fits
+    # max_plot_points, with the peaks marked at the count of their bucket
+    resolution = tweet.choose_resolution(start, end, params['max_plot_points'])
+    if resolution > params['interval_seconds']:
+        timeline = tweet.rollup_counts(hashtag, start, end, resolution)
+        bucket = (np.asarray(peak_time) - timeline['time'].values[0]) // np.timedelta64(resolution, 's')
+        tweet.plot_Ntweets(timeline, peak_time, timeline['count'].values[bucket.astype(int)],
+                           hashtag, start_time, ntweet_png)
     else:
-        peak_vals, peak_time, peak_groups, peak_tweets = tweet.get_peaks(tweet_count)
-        tweet_kw = tweet.textrank_analysis(peak_tweets, orig_tag=hashtag)
-        tweet.plot_Ntweets(tweet_count, peak_time, peak_vals, hashtag, start_time)
-        tweet.plot_timeline(peak_vals, tweet_kw, hashtag, start_time)
+        tweet.plot_Ntweets(tweet_count, peak_time, peak_vals, hashtag, start_time, ntweet_png)
+    tweet.plot_timeline(peak_vals, tweet_kw, hashtag, start_time, timeline_png)
+    result.update(peak_vals = list(peak_vals), peak_time = [str(t) for t in peak_time],
+                  keywords = list(tweet_kw),
+                  plots = {'Ntweets': ntweet_png.getvalue(), 'timeline': timeline_png.getvalue()})
+    return result
+
+def run_and_cache(key, hashtag, start_time, duration):
+    try:
+        result = run_analysis(hashtag, start_time, duration)
+        # Partial results are only served until the rest of the window can be fetched
+        results.put(key, result, None if result['complete'] else partial_result_ttl)
+    finally:
+        with pending_lock:
+            pending.pop(key, None)
 
 
 @app.route('/')
@@ -56,18 +143,28 @@ def whats_missed_output():
   hashtag = request.args.get('hashtag')
   start_time = str(request.args.get('start_time'))
   duration = request.args.get('duration')
-  ntweet_file = 'Ntweets_' + hashtag.strip('#') + '_' + start_time + '.png'
-  timeline_file = 'timeline_' + hashtag.strip('#') + '_' + start_time + '.png'
-  ntweet_plot_dir = '/home/ubuntu/nofomo/flaskapp/flaskexample/static/' + ntweet_file
-  if os.path.isfile(ntweet_plot_dir):
-      return render_template("whats_missed_output.html", hashtag = hashtag, ntweet_plot = '../static/' + ntweet_file,
-                             timeline_plot = '../static/' + timeline_file)
-  else:
-      warning_cases_dir = 'flaskexample/static/warning_cases.txt'
-      with open(warning_cases_dir) as f:
-          for line in f:
-              hash, time = line.strip().split('\t')
-              if hash == hashtag.strip('#') and time == start_time:
-                  return render_template("whats_missed_warning.html")
-      executor.submit(run_analysis, hashtag, start_time, duration)
+  key = analysis_key(hashtag, start_time, duration)
+  result = results.get(key)
+  if result is None:
+      # Submit each analysis once, however often the page is reloaded meanwhile
+      with pending_lock:
+          if key not in pending:
+              pending[key] = executor.submit(run_and_cache, key, hashtag, start_time, duration)
       return render_template("whats_missed_delay.html")
+  if result['warning']:
+      return render_template("whats_missed_warning.html")
+  return render_template("whats_missed_output.html", hashtag = hashtag,
+                         ntweet_plot = url_for('analysis_plot', key = key, name = 'Ntweets'),
+                         timeline_plot = url_for('analysis_plot', key = key, name = 'timeline'))
+
+@app.route('/plots/<key>/<name>.png')
+def analysis_plot(key, name):
+  result = results.get(key)
+  if result is None or name not in result.get('plots', {}):
+      abort(404)
+  return Response(result['plots'][name], mimetype = 'image/png')
+
+@app.route('/cache')
+def result_cache():
+  # Inspect the result cache
+  return jsonify(metrics = results.metrics(), pending = len(pending), entries = results.describe())